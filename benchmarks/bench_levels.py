@@ -0,0 +1,79 @@
+"""Level calculation: the old while-loop against levels.LevelCurve, plus the bulk recompute.
+
+    python benchmarks/bench_levels.py --rows 100000 1000000
+
+The loop's cost grows with the user's level, so it is timed at several point totals.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def loop_level(points):
+    """ The calculate_level that used to live in app.py. """
+    level = 1
+    threshold = 50
+    while points >= threshold:
+        level += 1
+        if level % 2 == 0:
+            threshold += 50
+    return level, threshold - points
+
+
+def bench_lookup(curve):
+    print(f"{'points':>10} {'loop µs':>10} {'curve µs':>10} {'speed-up':>9}")
+    for points in (10, 500, 5000, 50000, 500000):
+        assert loop_level(points) == curve.level(points)
+        number = max(10, 200000 // (points // 50 + 1))
+        loop = timeit.timeit(lambda: loop_level(points), number=number) / number * 1e6
+        number = 200000
+        closed = timeit.timeit(lambda: curve.level(points), number=number) / number * 1e6
+        print(f"{points:>10} {loop:>10.3f} {closed:>10.3f} {loop / closed:>8.1f}x")
+
+
+def bench_recompute(rows_list):
+    import storage
+    from levels import LevelCurve, recompute_levels
+
+    steeper = LevelCurve([(0, 1), (100, 2)], points_per_step=100, levels_per_step=1)
+    print(f"\n{'rows':>10} {'recompute s':>12} {'unchanged s':>12}")
+    for rows in rows_list:
+        conn = sqlite3.connect(storage.DB_PATH)
+        conn.execute("DELETE FROM all_user_points")
+        conn.executemany("INSERT INTO all_user_points (user_id, points, level, points_to_next_level) VALUES (?, ?, ?, ?)",
+                         ((f"U{i}", random.randrange(5000), *loop_level(0)) for i in range(rows)))
+        conn.commit()
+        conn.close()
+
+        started = time.perf_counter()
+        changed = recompute_levels(steeper)
+        first = time.perf_counter() - started
+        started = time.perf_counter()
+        recompute_levels(steeper)  # nothing left to change: only reads
+        second = time.perf_counter() - started
+        print(f"{rows:>10} {first:>12.3f} {second:>12.3f}   ({changed} rows changed)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000])
+    args = parser.parse_args()
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench_levels.db")
+    import storage
+    from levels import level_curve
+    storage.init_db()
+
+    bench_lookup(level_curve)
+    bench_recompute(args.rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Scan path latency as the scans table grows.
+
+    python benchmarks/bench_scan_path.py --sizes 10000 100000 1000000
+
+For each table size this times the old cooldown query (full sort of the user's history),
+the indexed query used on a cache miss, and the full cooldown check + insert with a warm cache.
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+USERS = 5000
+SAMPLES = 2000
+
+
+INSERT = "INSERT INTO scans (user_id, site_id, floor_from, floor_to, scanned_at) VALUES (?, 1, 1, 2, ?)"
+
+
+def fill(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT OR IGNORE INTO sites (id, name) VALUES (1, '機械系館1')")
+    start = int(datetime.datetime(2025, 1, 1).timestamp())
+    batch = []
+    for i in range(rows):
+        batch.append((f"U{random.randrange(USERS)}", start + i * 7))
+        if len(batch) == 100000:
+            conn.executemany(INSERT, batch)
+            batch = []
+    conn.executemany(INSERT, batch)
+    conn.commit()
+    conn.close()
+
+
+def timed(func, samples=SAMPLES):
+    """ Returns (mean, p99) latency in microseconds. """
+    durations = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started) * 1e6)
+    durations.sort()
+    return sum(durations) / len(durations), durations[int(len(durations) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    import app  # creates the schema (including the index) in the temp database
+
+    raw = sqlite3.connect(os.environ["DB_PATH"])
+    loaded = 0
+    print(f"{'rows':>10} | {'old query':>14} | {'indexed miss':>14} | {'cached check+insert':>20}")
+    for size in sorted(args.sizes):
+        fill(os.environ["DB_PATH"], size - loaded)
+        loaded = size
+
+        users = [f"U{random.randrange(USERS)}" for _ in range(SAMPLES)]
+        it = iter(users * 3)
+
+        old_query = timed(lambda: raw.execute(
+            "SELECT scanned_at FROM scans NOT INDEXED WHERE user_id = ? ORDER BY scanned_at DESC LIMIT 1",
+            (next(it),)).fetchone(), samples=200)
+
+        app.last_scan_cache.clear()
+        indexed = timed(lambda: app.get_last_scan_time(next(it)))
+
+        scan_time = [datetime.datetime(2030, 1, 1)]
+
+        def scan():
+            user_id = next(it)
+            scan_time[0] += datetime.timedelta(seconds=1)
+            app.get_last_scan_time(user_id)
+            app.log_scan(user_id, "1-2F", "機械系館1", scan_time[0])
+        cached = timed(scan)
+        loaded += SAMPLES
+
+        print(f"{size:>10} | {old_query[0]:>8.1f} µs avg | {indexed[0]:>8.1f} µs avg | "
+              f"{cached[0]:>8.1f} µs avg, p99 {cached[1]:.0f} µs")
+
+    raw.close()
+
+
+if __name__ == "__main__":
+    main()
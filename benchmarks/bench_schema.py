@@ -0,0 +1,127 @@
+"""Schema version 1 (text times and floors) against version 2 (typed scans table): size and hot queries.
+
+    python benchmarks/bench_schema.py --rows 1000000
+
+Builds a version 1 database, measures it, migrates it with storage.init_db() and
+storage.migrate_legacy_scans(), then measures again. Sizes are taken after VACUUM.
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+USERS = 5000
+SITES = ["機械系館1", "機械系館2", "電機系館", "總圖書館", "資訊工程系館"]
+FLOORS = ["1-2F", "2-3F", "3-4F", "4-5F", "1-3F"]
+SAMPLES = 2000
+
+
+def build_v1(path, rows):
+    """ The tables as init_db() created them before schema version 2, filled with `rows` scans. """
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE scan_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, floor TEXT, location TEXT, timestamp TEXT);
+        CREATE INDEX idx_scan_logs_user_time ON scan_logs (user_id, timestamp);
+        CREATE TABLE all_user_points (user_id TEXT PRIMARY KEY, points INTEGER DEFAULT 0, level INTEGER DEFAULT 0,
+                                      points_to_next_level INTEGER DEFAULT 0, ranking INTEGER DEFAULT NULL);
+    """)
+    start = datetime.datetime(2024, 1, 1)
+    batch = []
+    for i in range(rows):
+        scan_time = start + datetime.timedelta(seconds=i * 7)
+        batch.append((f"U{random.randrange(USERS):08d}", random.choice(FLOORS), random.choice(SITES),
+                      scan_time.strftime("%Y/%m/%d %H:%M:%S")))
+        if len(batch) == 100000:
+            conn.executemany("INSERT INTO scan_logs (user_id, floor, location, timestamp) VALUES (?, ?, ?, ?)", batch)
+            batch = []
+    conn.executemany("INSERT INTO scan_logs (user_id, floor, location, timestamp) VALUES (?, ?, ?, ?)", batch)
+    conn.executemany("INSERT INTO all_user_points (user_id, points) VALUES (?, ?)",
+                     [(f"U{i:08d}", random.randrange(1000)) for i in range(USERS)])
+    conn.commit()
+    conn.close()
+
+
+def file_size(path):
+    conn = sqlite3.connect(path)
+    conn.execute("VACUUM")
+    size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+    conn.close()
+    return size
+
+
+def timed(func, samples=SAMPLES):
+    """ Mean latency in microseconds. """
+    started = time.perf_counter()
+    for _ in range(samples):
+        func()
+    return (time.perf_counter() - started) / samples * 1e6
+
+
+def cooldown_v1(conn, user_id):
+    row = conn.execute("SELECT MAX(timestamp) FROM scan_logs WHERE user_id = ?", (user_id,)).fetchone()
+    return datetime.datetime.strptime(row[0], "%Y/%m/%d %H:%M:%S") if row[0] else None
+
+
+def cooldown_v2(conn, user_id):
+    row = conn.execute("SELECT MAX(scanned_at) FROM scans WHERE user_id = ?", (user_id,)).fetchone()
+    return datetime.datetime.fromtimestamp(row[0]) if row[0] is not None else None
+
+
+def history_v1(conn):
+    """ Floors per user as the impact backfill computed them from text floors. """
+    totals = {}
+    for user_id, floor in conn.execute("SELECT user_id, floor FROM scan_logs"):
+        start, end = floor.rstrip("F").split("-")
+        totals[user_id] = totals.get(user_id, 0) + int(end) - int(start)
+    return totals
+
+
+def history_v2(conn):
+    return dict(conn.execute("SELECT user_id, SUM((floor_to - floor_from) * scans) FROM scan_history GROUP BY user_id"))
+
+
+def measure(label, path, rows, cooldown, history):
+    size = file_size(path)
+    conn = sqlite3.connect(path)
+    users = iter([f"U{random.randrange(USERS):08d}" for _ in range(SAMPLES)])
+    lookup = timed(lambda: cooldown(conn, next(users)))
+    started = time.perf_counter()
+    totals = history(conn)
+    aggregate = time.perf_counter() - started
+    conn.close()
+    print(f"{label:<10} {size / 2 ** 20:>9.1f} MiB {size / rows:>8.1f} B/row "
+          f"{lookup:>10.1f} µs {aggregate * 1000:>12.0f} ms")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, "bench.db")
+    build_v1(path, args.rows)
+
+    print(f"{'schema':<10} {'file':>13} {'':>12} {'cooldown':>13} {'floors/user':>15}")
+    before = measure("version 1", path, args.rows, cooldown_v1, history_v1)
+
+    os.environ["DB_PATH"] = path
+    import storage
+    started = time.perf_counter()
+    storage.init_db()
+    moved = storage.migrate_legacy_scans()
+    print(f"migrated {moved} scans in {time.perf_counter() - started:.1f} s")
+
+    after = measure("version 2", path, args.rows, cooldown_v2, history_v2)
+    assert before == after, "floor totals changed during the migration"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""End-to-end load test: signed webhook traffic against the app under gunicorn, with LINE stubbed out.
+
+    python benchmarks/loadtest.py --duration 30 --concurrency 32 --workers 4
+    python benchmarks/loadtest.py --async --output benchmarks/results/async.json --compare benchmarks/results/sync.json
+
+Starts line_stub.py in-process (it also answers the Google Geolocation calls), starts gunicorn
+on a fresh database with LINE_API_ENDPOINT pointed at the stub, and sends correctly signed
+webhook bodies with a mix of follows, postbacks, QR scans, stickers and feedback.
+Pass --url to load an app that is already running instead (it must use --secret).
+
+Reports throughput, p50/p95/p99 latency and error rates per event type, and saves them as JSON.
+"""
+import argparse
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from line_stub import make_server  # noqa: E402
+from qr_signing import make_payload  # noqa: E402
+from sites import site_registry  # noqa: E402
+
+QR_SECRET = "loadtest-qr-secret"
+
+# Relative weight of each kind of event in the generated traffic
+EVENT_MIX = {
+    "follow": 2,
+    "postback": 40,
+    "qr_scan": 35,
+    "sticker": 8,
+    "feedback": 5,
+    "text": 10,
+}
+POSTBACKS = ["check_progress", "view_leaderboard", "personal_impacts", "all_users_impacts", "points_ranking",
+             "impacts", "others_menu", "how_to_play", "language_English", "language_Chinese"]
+TEXTS = ["points", "impacts", "how to play", "about us", "hello"]
+
+
+class EventFactory:
+    """ Builds LINE webhook events for a fixed population of users. """
+
+    def __init__(self, users, seed=None):
+        self.random = random.Random(seed)
+        self.users = [f"U{uuid.UUID(int=self.random.getrandbits(128)).hex}" for _ in range(users)]
+        self.qr_codes = [make_payload(floor, site.name, secret=QR_SECRET) for site in site_registry for floor in site.floor_labels]
+        self.kinds, self.weights = zip(*EVENT_MIX.items())
+
+    def _event(self, user_id, **fields):
+        return {
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "replyToken": uuid.uuid4().hex,
+            "webhookEventId": uuid.uuid4().hex.upper()[:26],
+            "deliveryContext": {"isRedelivery": False},
+            **fields,
+        }
+
+    def _text(self, user_id, text):
+        return self._event(user_id, type="message", message={"type": "text", "id": str(self.random.getrandbits(48)), "text": text})
+
+    def make(self):
+        """ Returns (kind, event) for one randomly chosen event. """
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        user_id = self.random.choice(self.users)
+        if kind == "follow":
+            event = self._event(user_id, type="follow")
+        elif kind == "postback":
+            event = self._event(user_id, type="postback", postback={"data": self.random.choice(POSTBACKS)})
+        elif kind == "qr_scan":
+            event = self._text(user_id, self.random.choice(self.qr_codes))
+        elif kind == "sticker":
+            event = self._event(user_id, type="message", message={"type": "sticker", "id": "1", "packageId": "446", "stickerId": "1988"})
+        elif kind == "feedback":
+            event = self._text(user_id, "I would like to provide feedback or report an issue:\nThe 3F door is locked")
+        else:
+            event = self._text(user_id, self.random.choice(TEXTS))
+        return kind, event
+
+
+def sign(body, secret):
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(samples, elapsed):
+    """ samples: list of (latency_seconds, ok). """
+    latencies = sorted(latency for latency, _ in samples)
+    errors = sum(1 for _, ok in samples if not ok)
+    return {
+        "requests": len(samples),
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def run_load(url, secret, factory, concurrency, duration, max_requests, events_per_request):
+    """ Sends webhooks from `concurrency` threads until `duration` seconds or `max_requests` requests. """
+    samples = defaultdict(list)  # kind -> [(latency, ok)]
+    statuses = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    sent = [0]
+
+    def worker():
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            with lock:
+                if max_requests and sent[0] >= max_requests:
+                    return
+                sent[0] += 1
+                batch = [factory.make() for _ in range(events_per_request)]
+            body = json.dumps({"destination": "Uloadtest", "events": [event for _, event in batch]}).encode("utf-8")
+            headers = {"Content-Type": "application/json", "X-Line-Signature": sign(body, secret)}
+            started = time.perf_counter()
+            try:
+                status = session.post(url, data=body, headers=headers, timeout=30).status_code
+            except requests.RequestException:
+                status = "connection_error"
+            latency = time.perf_counter() - started
+            with lock:
+                statuses[str(status)] += 1
+                samples[batch[0][0] if events_per_request == 1 else "batch"].append((latency, status == 200))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.monotonic() - started
+
+    all_samples = [sample for kind_samples in samples.values() for sample in kind_samples]
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "overall": summarize(all_samples, elapsed),
+        "by_kind": {kind: summarize(kind_samples, elapsed) for kind, kind_samples in sorted(samples.items())},
+        "status_codes": dict(statuses),
+    }
+
+
+def start_gunicorn(port, stub_url, args, db_path):
+    env = dict(
+        os.environ,
+        LINE_CHANNEL_SECRET=args.secret,
+        LINE_ACCESS_TOKEN="loadtest-token",
+        LINE_API_ENDPOINT=stub_url,
+        LINE_API_DATA_ENDPOINT=stub_url,
+        GOOGLE_API_KEY="loadtest-key",
+        GOOGLE_GEOLOCATION_URL=f"{stub_url}/geolocation/v1/geolocate",
+        LOCATION_VERIFIERS="user_position,google",
+        QR_SECRET=QR_SECRET,
+        DB_PATH=db_path,
+        WEBHOOK_ASYNC="1" if args.async_mode else "0",
+    )
+    command = [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+               "--workers", str(args.workers), "--threads", str(args.threads), "--log-level", "warning"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    # Wait until every worker has imported the app
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"🚨 gunicorn exited with code {process.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/webhook/stats", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("🚨 gunicorn did not start within 60 seconds")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results, baseline=None):
+    print(f"\n{'kind':<12} {'requests':>9} {'rps':>8} {'errors':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = [("overall", results["overall"])] + list(results["by_kind"].items())
+    for kind, row in rows:
+        print(f"{kind:<12} {row['requests']:>9} {row['throughput_rps']:>8} {row['error_rate']:>8.2%} "
+              f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}")
+    print(f"\nstatus codes: {results['status_codes']}")
+    print(f"LINE API calls: {sum(results['line_api_calls'].values())}")
+
+    if baseline:
+        print(f"\nCompared with {baseline.get('revision')} ({baseline.get('started_at')}):")
+        for key in ("throughput_rps", "error_rate", "p50_ms", "p95_ms", "p99_ms"):
+            old, new = baseline["overall"][key], results["overall"][key]
+            change = f"{(new - old) / old:+.1%}" if old else "n/a"
+            print(f"  {key:<15} {old:>10} -> {new:<10} ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /webhook with signed LINE events")
+    parser.add_argument("--url", help="webhook URL of an app that is already running (skips gunicorn)")
+    parser.add_argument("--secret", default="loadtest-secret", help="LINE channel secret used to sign bodies")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0 = no limit)")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--events-per-request", type=int, default=1)
+    parser.add_argument("--users", type=int, default=500, help="number of distinct users")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="threads per gunicorn worker")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="run the app with WEBHOOK_ASYNC=1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--stub-port", type=int, default=5056)
+    parser.add_argument("--stub-latency", type=float, default=0.02, help="seconds the stub waits before answering")
+    parser.add_argument("--stub-fail-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="where to save the JSON results")
+    parser.add_argument("--compare", default=None, help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    stub = make_server(port=args.stub_port, fail_rate=args.stub_fail_rate, latency=args.stub_latency)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+
+    gunicorn = None
+    tmpdir = tempfile.TemporaryDirectory()
+    url = args.url
+    if not url:
+        gunicorn = start_gunicorn(args.port, stub_url, args, os.path.join(tmpdir.name, "loadtest.db"))
+        url = f"http://127.0.0.1:{args.port}/webhook"
+
+    factory = EventFactory(args.users, seed=args.seed)
+    started_at = datetime.datetime.now().isoformat(timespec="seconds")
+    print(f"⏱️ Sending webhooks to {url} for {args.duration}s with {args.concurrency} clients")
+    try:
+        results = run_load(url, args.secret, factory, args.concurrency, args.duration, args.requests,
+                           args.events_per_request)
+        time.sleep(1 if args.async_mode else 0)  # let queued events reach the stub
+    finally:
+        if gunicorn:
+            gunicorn.terminate()
+            gunicorn.wait(timeout=30)
+        tmpdir.cleanup()
+    stub.shutdown()
+
+    results.update({
+        "revision": git_revision(),
+        "started_at": started_at,
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "secret")},
+        "line_api_calls": dict(stub.calls),
+    })
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results",
+                                         f"loadtest-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"\n✅ Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Announcements to many users at once through the LINE multicast API.
+
+    python broadcast.py winners --month 2025-03 [--dry-run]
+    python broadcast.py nudge --idle-days 14 [--dry-run]
+
+Recipients are selected with one query and split into chunks of up to 500 users per language.
+Messages are rendered once per language. The messages and the recipients are saved before
+anything is sent, and each chunk is marked as sent when LINE accepts it, so running the same
+broadcast again after a crash only sends the chunks that are left. Every chunk has a fixed
+X-Line-Retry-Key, so a chunk that LINE accepted just before the crash is not delivered twice.
+
+--dry-run sends everything to an in-process LINE stub (see line_stub.py) instead.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+import metrics
+import rollups
+import storage
+from i18n import LANGUAGES, DEFAULT_LANGUAGE, UserContext
+from line_transport import make_line_bot_api, LINE_API_ENDPOINT
+from profiles import ProfileCache
+
+logger = logging.getLogger(__name__)
+
+LINE_ACCESS_TOKEN = os.getenv("LINE_ACCESS_TOKEN", "YOUR_ACCESS_TOKEN_HERE")
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "4"))
+MULTICAST_MAX_RECIPIENTS = 500  # LINE accepts at most 500 user ids per multicast call
+
+RETRY_KEY_NAMESPACE = uuid.UUID("6f1c1f0e-3b7a-4a55-9f5e-2f0f6d1f8a21")
+
+BROADCAST_RECIPIENTS = metrics.counter("staircase_broadcast_recipients", "Broadcast recipients by outcome", ["result"])
+
+# Everyone who followed the bot or scanned at least once, with their language
+RECIPIENTS = f"""
+    SELECT u.user_id, COALESCE(s.language, '{DEFAULT_LANGUAGE}') AS language
+    FROM (SELECT user_id FROM user_settings UNION SELECT user_id FROM all_user_points) u
+    LEFT JOIN user_settings s ON s.user_id = u.user_id
+"""
+
+
+def winners_messages(month, k=3, profiles=None):
+    """ {language: [text]} announcing the top climbers of a month ("YYYY-MM"), by name where `profiles` knows it. """
+    now = datetime.datetime.strptime(month, "%Y-%m")
+    winners = rollups.top("month", k, now)
+    names = profiles.names([uid for uid, _, _ in winners]) if profiles else {}
+    medal_emojis = ["🥇", "🥈", "🥉"]
+    messages = {}
+    for language in LANGUAGES:
+        ctx = UserContext(None, language)
+        text = ctx.render("monthly_winners", month=month)
+        for i, (uid, points, rank) in enumerate(winners):
+            name = names.get(uid)
+            text += ctx.render("period_rank_info_named" if name else "period_rank_info",
+                               medal=medal_emojis[i] if i < len(medal_emojis) else "🏅", rank=rank, name=name, points=points)
+        messages[language] = [text + "\n" + ctx.text("keep_climbing")]
+    return messages
+
+
+def nudge_messages(now=None):
+    """ {language: [text]} inviting users back, with this month's floors climbed by everyone. """
+    month = rollups.month_key(now or datetime.datetime.now())
+    floors = sum(floors for _, _, floors in rollups.building_totals(month))
+    return {language: [UserContext(None, language).render("progress_nudge", floors=floors)] for language in LANGUAGES}
+
+
+def create(broadcast_id, messages, where="", params=()):
+    """ Saves a broadcast and its recipients (RECIPIENTS filtered by `where`). Does nothing if it already exists.
+
+    Returns True if the broadcast was created, False if an earlier run created it (and it will be resumed).
+    """
+    with storage.transaction() as conn:
+        if conn.execute("SELECT 1 FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone():
+            return False
+        conn.execute("INSERT INTO broadcasts (id, messages, created_at) VALUES (?, ?, ?)",
+                     (broadcast_id, json.dumps(messages, ensure_ascii=False), int(time.time())))
+        conn.execute(f"""
+            INSERT INTO broadcast_recipients (broadcast_id, user_id, language, chunk)
+            SELECT ?, user_id, language, (ROW_NUMBER() OVER (PARTITION BY language ORDER BY user_id) - 1) / ?
+            FROM ({RECIPIENTS}) {where}
+        """, (broadcast_id, MULTICAST_MAX_RECIPIENTS, *params))
+    return True
+
+
+def _retry_key(broadcast_id, language, chunk):
+    """ Same key for the same chunk on every run, so LINE drops a resend of a chunk it already accepted. """
+    return str(uuid.uuid5(RETRY_KEY_NAMESPACE, f"{broadcast_id}/{language}/{chunk}"))
+
+
+def _send_chunk(broadcast_id, language, chunk, messages, endpoint):
+    """ Multicasts one chunk and marks its recipients as sent. Returns the number of recipients. """
+    user_ids = [row[0] for row in storage.query_all("""
+        SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND language = ? AND chunk = ? AND sent_at IS NULL
+    """, (broadcast_id, language, chunk))]
+    if not user_ids:
+        return 0
+
+    # A LineBotApi per call: multicast() stores the retry key in the instance's headers
+    line_bot_api = make_line_bot_api(LINE_ACCESS_TOKEN, endpoint)
+    try:
+        line_bot_api.multicast(user_ids, [TextSendMessage(text=text) for text in messages],
+                               retry_key=_retry_key(broadcast_id, language, chunk))
+    except LineBotApiError as e:
+        if e.status_code != 409:  # 409: this retry key was already accepted, i.e. sent before a crash
+            raise
+
+    storage.execute("""
+        UPDATE broadcast_recipients SET sent_at = ? WHERE broadcast_id = ? AND language = ? AND chunk = ?
+    """, (int(time.time()), broadcast_id, language, chunk))
+    return len(user_ids)
+
+
+def send(broadcast_id, concurrency=BROADCAST_CONCURRENCY, endpoint=LINE_API_ENDPOINT):
+    """ Sends every chunk of a broadcast that has not been sent yet. Returns (recipients sent, recipients failed). """
+    row = storage.query_one("SELECT messages FROM broadcasts WHERE id = ?", (broadcast_id,))
+    if row is None:
+        raise ValueError(f"unknown broadcast {broadcast_id!r}")
+    messages = json.loads(row[0])
+    chunks = storage.query_all("""
+        SELECT language, chunk, COUNT(*) FROM broadcast_recipients
+        WHERE broadcast_id = ? AND sent_at IS NULL GROUP BY language, chunk
+    """, (broadcast_id,))
+
+    sent, failed = 0, 0
+    lock = threading.Lock()
+
+    def run(language, chunk, size):
+        nonlocal sent, failed
+        text = messages.get(language) or messages[DEFAULT_LANGUAGE]
+        try:
+            count = _send_chunk(broadcast_id, language, chunk, text, endpoint)
+        except Exception as e:
+            logger.error(f"🚨 Broadcast {broadcast_id}: chunk {chunk} ({language}) failed, it is sent on the next run: {e}")
+            BROADCAST_RECIPIENTS.labels(result="failed").inc(size)
+            with lock:
+                failed += size
+            return
+        BROADCAST_RECIPIENTS.labels(result="sent").inc(count)
+        with lock:
+            sent += count
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="broadcast") as executor:
+        for language, chunk, size in chunks:
+            executor.submit(run, language, chunk, size)
+
+    if not failed:
+        storage.execute("UPDATE broadcasts SET finished_at = ? WHERE id = ? AND finished_at IS NULL",
+                        (int(time.time()), broadcast_id))
+    return sent, failed
+
+
+def progress(broadcast_id):
+    """ Returns (recipients sent, total recipients) of a broadcast. """
+    return storage.query_one("""
+        SELECT COUNT(sent_at), COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ?
+    """, (broadcast_id,))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send an announcement to many users")
+    parser.add_argument("kind", choices=["winners", "nudge"])
+    parser.add_argument("--month", default=rollups.month_key(datetime.datetime.now().replace(day=1) - datetime.timedelta(days=1)),
+                        help="winners: YYYY-MM (default: last month)")
+    parser.add_argument("--top", type=int, default=3, help="winners: how many to announce")
+    parser.add_argument("--idle-days", type=int, default=14, help="nudge: only users without a scan in this many days")
+    parser.add_argument("--id", help="broadcast id (default: derived from the kind and date); reuse it to resume")
+    parser.add_argument("--concurrency", type=int, default=BROADCAST_CONCURRENCY)
+    parser.add_argument("--dry-run", action="store_true", help="send to a local LINE stub instead of LINE")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    storage.init_db()
+    endpoint = LINE_API_ENDPOINT
+    if args.dry_run:
+        import line_stub
+        stub = line_stub.make_server(port=0)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        endpoint = f"http://127.0.0.1:{stub.server_address[1]}"
+
+    if args.kind == "winners":
+        broadcast_id = args.id or f"winners-{args.month}"
+        profiles = ProfileCache(make_line_bot_api(LINE_ACCESS_TOKEN, endpoint))
+        messages, where, params = winners_messages(args.month, args.top, profiles), "", ()
+    else:
+        broadcast_id = args.id or f"nudge-{datetime.date.today()}"
+        since = rollups.day_key(datetime.datetime.now() - datetime.timedelta(days=args.idle_days))
+        messages = nudge_messages()
+        where, params = "WHERE user_id NOT IN (SELECT user_id FROM user_daily_stats WHERE day >= ?)", (since,)
+    if args.dry_run:
+        broadcast_id += ".dry-run"  # its own progress, so a dry run never marks the real broadcast as sent
+
+    if not create(broadcast_id, messages, where, params):
+        print(f"↩️ Resuming broadcast {broadcast_id}")
+    sent, failed = send(broadcast_id, args.concurrency, endpoint)
+    done, total = progress(broadcast_id)
+    print(f"✅ Broadcast {broadcast_id}: {sent} sent now, {done}/{total} in total" + (f", {failed} failed" if failed else ""))
+    if args.dry_run:
+        print(f"📭 LINE stub received {dict(stub.calls)}")
+        for language, texts in messages.items():
+            print(f"--- {language}\n" + "\n".join(texts))
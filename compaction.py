@@ -0,0 +1,126 @@
+"""Compaction of old scans.
+
+    python compaction.py --horizon-days 90 --archive-dir archive [--vacuum]
+
+Raw scans older than the horizon are folded into scan_daily_summary (one row per user, staircase and
+day, with a scan count) and deleted from scans. With --archive-dir the raw rows are first appended
+to gzip-compressed monthly JSON-lines files (scans-YYYY-MM.jsonl.gz). Impact, points and rollups
+are kept in their own tables, and the one-off backfills read summaries as well as raw rows, so every
+figure stays the same.
+
+Work is done in small transactions, so the bot keeps running while it compacts.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+COMPACTION_HORIZON_DAYS = int(os.getenv("COMPACTION_HORIZON_DAYS", "90"))
+COMPACTION_BATCH_ROWS = int(os.getenv("COMPACTION_BATCH_ROWS", "10000"))
+SCAN_ARCHIVE_DIR = os.getenv("SCAN_ARCHIVE_DIR", "")
+
+
+def _append_archive(archive_dir, rows):
+    """ Appends raw rows to their monthly archive files, one gzip member per call (readable with gzip.open). """
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(datetime.datetime.fromtimestamp(row[-1]).strftime("%Y-%m"), []).append(row)
+
+    os.makedirs(archive_dir, exist_ok=True)
+    for month, month_rows in by_month.items():
+        path = os.path.join(archive_dir, f"scans-{month}.jsonl.gz")
+        with open(path, "ab") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb") as archive:
+                for scan_id, user_id, site_id, location, floor_from, floor_to, scanned_at in month_rows:
+                    line = {"id": scan_id, "user_id": user_id, "site_id": site_id, "location": location,
+                            "floor_from": floor_from, "floor_to": floor_to, "scanned_at": scanned_at}
+                    archive.write((json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())  # on disk before the rows are deleted
+
+
+def read_archive(path):
+    """ Yields the archived scans of one file. An interrupted run can archive a batch twice; repeats are skipped by id. """
+    seen = set()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            scan = json.loads(line)
+            if scan["id"] not in seen:
+                seen.add(scan["id"])
+                yield scan
+
+
+def compact_batch(cutoff, archive_dir=None, batch_rows=COMPACTION_BATCH_ROWS):
+    """ Folds up to `batch_rows` of the oldest scans before `cutoff` into daily summaries. Returns the number of rows.
+
+    The batch is read and archived without holding the write lock, so scan writers only wait for the
+    summary update and the DELETE. Rows another run removed in the meantime are left out.
+    """
+    cutoff_at = int(cutoff.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())  # whole days only
+    select = """
+        SELECT scans.id, user_id, site_id, COALESCE(sites.name, ''), floor_from, floor_to, scanned_at
+        FROM scans LEFT JOIN sites ON sites.id = scans.site_id
+        WHERE scanned_at < ? {} ORDER BY scans.id
+    """
+    rows = storage.query_all(select.format("") + " LIMIT ?", (cutoff_at, batch_rows))
+    if not rows:
+        return 0
+
+    if archive_dir:
+        _append_archive(archive_dir, rows)  # an archived row that is not deleted below is skipped by read_archive
+
+    with storage.transaction() as conn:
+        # Only the archived rows that are still there, unchanged
+        archived = set(rows)
+        rows = [row for row in conn.execute(select.format("AND scans.id BETWEEN ? AND ?"), (cutoff_at, rows[0][0], rows[-1][0]))
+                if row in archived]
+        if not rows:
+            return 0
+
+        summaries = {}
+        for _, user_id, site_id, _, floor_from, floor_to, scanned_at in rows:
+            key = (datetime.datetime.fromtimestamp(scanned_at).strftime("%Y-%m-%d"), user_id, site_id, floor_from, floor_to)
+            summaries[key] = summaries.get(key, 0) + 1
+        conn.executemany("""
+            INSERT INTO scan_daily_summary (day, user_id, site_id, floor_from, floor_to, scans) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(day, user_id, site_id, floor_from, floor_to) DO UPDATE SET scans = scans + excluded.scans
+        """, [(*key, scans) for key, scans in summaries.items()])
+        conn.executemany("DELETE FROM scans WHERE id = ?", [(row[0],) for row in rows])
+    return len(rows)
+
+
+def compact(horizon_days=COMPACTION_HORIZON_DAYS, archive_dir=SCAN_ARCHIVE_DIR, batch_rows=COMPACTION_BATCH_ROWS, now=None):
+    """ Compacts every scan older than `horizon_days`. Returns the number of raw rows folded into summaries. """
+    if horizon_days < 1:
+        raise ValueError("the horizon must be at least one day, recent scans are needed for the cooldown check")
+    cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=horizon_days)
+
+    total = 0
+    while True:
+        compacted = compact_batch(cutoff, archive_dir or None, batch_rows)
+        total += compacted
+        if compacted < batch_rows:
+            return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fold old scans into daily summaries")
+    parser.add_argument("--horizon-days", type=int, default=COMPACTION_HORIZON_DAYS, help="keep raw scans this recent")
+    parser.add_argument("--archive-dir", default=SCAN_ARCHIVE_DIR, help="also keep the raw rows in monthly .jsonl.gz files here")
+    parser.add_argument("--batch-rows", type=int, default=COMPACTION_BATCH_ROWS, help="rows per transaction")
+    parser.add_argument("--vacuum", action="store_true", help="shrink the database file afterwards (blocks writers while it runs)")
+    args = parser.parse_args()
+
+    storage.init_db()
+    compacted = compact(args.horizon_days, args.archive_dir, args.batch_rows)
+    print(f"✅ Folded {compacted} scans older than {args.horizon_days} days into daily summaries")
+    if args.vacuum:
+        with storage.pool.connection() as conn:
+            conn.execute("VACUUM")
+        print("✅ Database file shrunk")
@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+
+import storage
+from cache import LRUCache, MISSING
+
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", str(24 * 3600)))  # how long event ids are remembered, in seconds
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "50000"))
+PURGE_EVERY = 1000  # events between deletions of expired ids from the table
+
+
+class EventDeduplicator:
+    """ Drops webhook events that were already handled, keyed on their webhookEventId.
+
+    Ids are kept in a bounded in-memory set (fast path) and in the processed_events table,
+    so a redelivery is recognised even when it reaches a different gunicorn worker.
+    """
+
+    def __init__(self, ttl=DEDUP_TTL, maxsize=DEDUP_CACHE_SIZE):
+        self.ttl = ttl
+        self.seen = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._since_purge = 0
+        self.duplicates = 0
+        self.redeliveries = 0
+
+    def first_time(self, event):
+        """ Records the event and returns True, or returns False if it was seen before. """
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            return True
+
+        delivery_context = getattr(event, "delivery_context", None)
+        if getattr(delivery_context, "is_redelivery", False):
+            self.redeliveries += 1
+
+        if self.seen.get(event_id) is not MISSING:
+            self.duplicates += 1
+            return False
+
+        now = int(time.time())
+        inserted = storage.execute("INSERT OR IGNORE INTO processed_events (event_id, seen_at) VALUES (?, ?)", (event_id, now))
+        self.seen.set(event_id, True)
+        if not inserted:
+            self.duplicates += 1
+            return False
+
+        self._maybe_purge(now)
+        return True
+
+    def forget(self, event):
+        """ Undoes first_time() for an event that was not handled, so LINE's redelivery of it is let through. """
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            return
+        self.seen.invalidate(event_id)
+        storage.execute("DELETE FROM processed_events WHERE event_id = ?", (event_id,))
+
+    def _maybe_purge(self, now):
+        with self._lock:
+            self._since_purge += 1
+            if self._since_purge < PURGE_EVERY:
+                return
+            self._since_purge = 0
+        storage.execute("DELETE FROM processed_events WHERE seen_at < ?", (now - self.ttl,))
+
+    def stats(self):
+        return {"duplicates": self.duplicates, "redeliveries": self.redeliveries, "seen": len(self.seen)}
+
+
+deduplicator = EventDeduplicator()
@@ -0,0 +1,168 @@
+"""Streaming exports of scans, feedback and points as CSV or JSON lines.
+
+    python export.py scans --since 2025-03-01 --until 2025-04-01 --building 機械系館1 --gzip -o march.csv.gz
+
+The same exports are served by GET /admin/export/<table> (see app.py). Rows are read from
+the cursor a chunk at a time and written out as they come, so memory use does not depend on
+the table size. Reads run on their own snapshot (WAL), so the bot keeps writing meanwhile.
+"""
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import zlib
+
+import metrics
+import storage
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+EXPORTED_ROWS = metrics.counter("staircase_export_rows", "Rows written by admin exports", ["table"])
+
+
+class Export:
+    """ One exportable table: its query, and the columns the time range and building filters apply to. """
+
+    def __init__(self, sql, order_by, time_column=None, time_format=None, building_column=None):
+        self.sql = sql
+        self.order_by = order_by
+        self.time_column = time_column
+        self.time_format = time_format  # None: the column holds epoch seconds
+        self.building_column = building_column
+
+    def query(self, since=None, until=None, building=None):
+        """ Returns the SQL and parameters for the filtered export. Raises ValueError for filters the table lacks. """
+        conditions, params = [], []
+        if since or until:
+            if not self.time_column:
+                raise ValueError("this export cannot be filtered by time")
+            for bound, operator in ((since, ">="), (until, "<")):
+                if bound:
+                    conditions.append(f"{self.time_column} {operator} ?")
+                    params.append(bound.strftime(self.time_format) if self.time_format else int(bound.timestamp()))
+        if building:
+            if not self.building_column:
+                raise ValueError("this export cannot be filtered by building")
+            conditions.append(f"{self.building_column} = ?")
+            params.append(building)
+
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return f"{self.sql}{where} ORDER BY {self.order_by}", params
+
+
+EXPORTS = {
+    # Raw scans (the ones compaction has not folded into daily summaries yet)
+    "scans": Export("""
+        SELECT scans.id, user_id, sites.name AS location, floor_from, floor_to,
+               datetime(scanned_at, 'unixepoch', 'localtime') AS scanned_at
+        FROM scans LEFT JOIN sites ON sites.id = scans.site_id
+    """, "scans.id", time_column="scans.scanned_at", building_column="sites.name"),
+    # Every scan ever made, per user, staircase and day (raw and compacted)
+    "scan_history": Export("""
+        SELECT day, user_id, sites.name AS location, floor_from, floor_to, scans
+        FROM scan_history LEFT JOIN sites ON sites.id = scan_history.site_id
+    """, "day, user_id", time_column="day", time_format="%Y-%m-%d", building_column="sites.name"),
+    "feedback": Export("SELECT id, user_id, report, timestamp FROM feedback", "id",
+                       time_column="timestamp", time_format="%Y-%m-%d %H:%M:%S"),
+    "points": Export("SELECT user_id, points, level, points_to_next_level FROM all_user_points", "user_id"),
+}
+
+
+def parse_time(value):
+    """ Parses a --since/--until value ("2025-03-01" or "2025-03-01T08:00:00"); empty means unbounded. """
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+def _rows(table, sql, params, chunk_rows=EXPORT_CHUNK_ROWS):
+    """ Yields the column names, then every row of the query, reading `chunk_rows` at a time. """
+    with storage.pool.connection() as conn:
+        cursor = conn.execute(sql, params)
+        try:
+            yield [column[0] for column in cursor.description]
+            while True:
+                chunk = cursor.fetchmany(chunk_rows)
+                if not chunk:
+                    return
+                EXPORTED_ROWS.labels(table=table).inc(len(chunk))
+                yield from chunk
+        finally:
+            cursor.close()  # also when the client hangs up halfway, so the connection goes back clean
+
+
+def _encode(records, fmt):
+    """ Turns rows into text chunks of roughly one database chunk each. """
+    columns = next(records)
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+    else:
+        def write(row):
+            buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+
+    for i, row in enumerate(records, 1):
+        write(row)
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream(table, fmt="csv", since=None, until=None, building=None, compress=False):
+    """ Returns an iterator over the export as bytes, gzip-compressed on the fly if `compress` is set.
+
+    Bad arguments raise ValueError here, before anything is read or sent.
+    """
+    if table not in EXPORTS:
+        raise ValueError(f"unknown export {table!r}, expected one of {', '.join(EXPORTS)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}, expected one of {', '.join(FORMATS)}")
+    sql, params = EXPORTS[table].query(since, until, building)
+    return _stream(_rows(table, sql, params), fmt, compress)
+
+
+def _stream(records, fmt, compress):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits 31: gzip framing
+    for text in _encode(records, fmt):
+        data = text.encode("utf-8")
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+
+def filename(table, fmt, compress=False):
+    return f"{table}.{fmt}" + (".gz" if compress else "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export scans, feedback or points")
+    parser.add_argument("table", choices=sorted(EXPORTS))
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--since", type=parse_time, help="first day or time to include, e.g. 2025-03-01")
+    parser.add_argument("--until", type=parse_time, help="first day or time to leave out")
+    parser.add_argument("--building", help="only this building (scans and scan_history)")
+    parser.add_argument("--gzip", action="store_true", help="compress the output")
+    parser.add_argument("-o", "--output", help="file to write (default: standard output)")
+    args = parser.parse_args()
+
+    storage.init_db()
+    try:
+        chunks = stream(args.table, args.format, args.since, args.until, args.building, args.gzip)
+    except ValueError as e:
+        parser.error(str(e))
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    for chunk in chunks:
+        out.write(chunk)
+    if args.output:
+        out.close()
+        print(f"✅ Exported {args.table} to {args.output}", file=sys.stderr)
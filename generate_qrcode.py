@@ -1,39 +1,122 @@
 import qrcode
 import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+from sites import site_registry
+from qr_signing import make_payload, QR_SECRET
 
 BOT_ID = "@925keedn"
 
-# Function to generate QR locations dynamically
-def generate_qr_locations(location_name, floors):
-    return [{"floor": f"{i}-{i+1}F", "location": location_name} for i in range(1, floors + 1)]
-
-# List of locations with floors
-target_locations = [
-    ("機械系館1", 5),
-    ("機械系館2", 5)
-]
-
 # Root directory to store QR codes
 root_folder = "qrcodes"
+MANIFEST_FILE = "manifest.json"  # payload hash of every rendered code, so unchanged codes are skipped
+RENDER_VERSION = 1  # bump when the rendering itself changes, to re-render everything once
+
+# Print sheets: A4 at 150 dpi, 2 x 3 codes per page
+PAGE_SIZE = (1240, 1754)
+SHEET_COLUMNS, SHEET_ROWS = 2, 3
+LABEL_FONT = os.getenv("QR_LABEL_FONT")  # a font with CJK glyphs, to print building names on the sheets
+
+# Locations and floors come from the shared site registry (sites.json)
+def generate_qr_locations(site):
+    return [{"floor": floor, "location": site.name} for floor in site.floor_labels]
+
+def build_jobs():
+    """ One job per staircase: what to encode and where to save it. """
+    jobs = []
+    for site in site_registry:
+        for qr in generate_qr_locations(site):
+            # Format the message that will be sent to the bot
+            message = make_payload(qr['floor'], qr['location'])  # signed when QR_SECRET is set
+
+            # Create a LINE URL scheme that pre-fills the message
+            qr_code_url = f"line://oaMessage/{BOT_ID}/?{message}"
+
+            # Define folder for each location
+            file_name = os.path.join(root_folder, qr["location"], f"qr_{qr['floor']}.png")
+            digest = hashlib.sha256(f"{RENDER_VERSION}|{qr_code_url}".encode("utf-8")).hexdigest()
+            jobs.append({**qr, "url": qr_code_url, "file_name": file_name, "hash": digest})
+    return jobs
+
+def render_qr(job):
+    """ Generates and saves one QR code (runs in a worker process). """
+    os.makedirs(os.path.dirname(job["file_name"]), exist_ok=True)
+    qrcode.make(job["url"]).save(job["file_name"])
+    return job
+
+def load_manifest():
+    try:
+        with open(os.path.join(root_folder, MANIFEST_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    os.makedirs(root_folder, exist_ok=True)
+    with open(os.path.join(root_folder, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+def render_sheet(location, jobs):
+    """ Lays out a building's codes with their floor labels on A4 pages and saves them as one PDF. """
+    width, height = PAGE_SIZE
+    cell_w, cell_h = width // SHEET_COLUMNS, height // SHEET_ROWS
+    size = min(cell_w, cell_h) - 120
+    font = ImageFont.truetype(LABEL_FONT, 40) if LABEL_FONT else ImageFont.load_default()
+    per_page = SHEET_COLUMNS * SHEET_ROWS
+
+    pages = []
+    for start in range(0, len(jobs), per_page):
+        page = Image.new("RGB", PAGE_SIZE, "white")
+        draw = ImageDraw.Draw(page)
+        for i, job in enumerate(jobs[start:start + per_page]):
+            x = (i % SHEET_COLUMNS) * cell_w + (cell_w - size) // 2
+            y = (i // SHEET_COLUMNS) * cell_h + 20
+            with Image.open(job["file_name"]) as code:
+                page.paste(code.convert("RGB").resize((size, size)), (x, y))
+            label = f"{location} {job['floor']}" if LABEL_FONT else job["floor"]
+            draw.text((x, y + size + 10), label, fill="black", font=font)
+        pages.append(page)
+
+    sheet_name = os.path.join(root_folder, location, "sheet.pdf")
+    pages[0].save(sheet_name, save_all=True, append_images=pages[1:], resolution=150)
+    return sheet_name
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate staircase QR codes (only new or changed ones are rendered)")
+    parser.add_argument("--force", action="store_true", help="re-render every code")
+    parser.add_argument("--workers", type=int, default=None, help="number of render processes (default: CPU count)")
+    parser.add_argument("--sheets", action="store_true", help="also write one print-ready multi-page PDF per building")
+    args = parser.parse_args()
 
-# Generate QR codes
-qr_locations = []
-for location, floors in target_locations:
-    qr_locations.extend(generate_qr_locations(location, floors))
+    if not QR_SECRET:
+        print("⚠️ QR_SECRET is not set, generating unsigned QR codes")
 
-for qr in qr_locations:
-    # Format the message that will be sent to the bot
-    message = f"STAIRCASE_QR_{qr['floor']}_{qr['location']}"
+    jobs = build_jobs()
+    manifest = {} if args.force else load_manifest()
+    todo = [job for job in jobs if manifest.get(job["file_name"]) != job["hash"] or not os.path.exists(job["file_name"])]
 
-    # Create a LINE URL scheme that pre-fills the message
-    qr_code_url = f"line://oaMessage/{BOT_ID}/?{message}"
+    # Generate QR codes
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for job in executor.map(render_qr, todo, chunksize=8):
+            manifest[job["file_name"]] = job["hash"]
+            print(f"✅ QR Code saved: {job['file_name']} → {job['url']}")
 
-    # Define folder for each location
-    location_folder = os.path.join(root_folder, qr["location"])
-    os.makedirs(location_folder, exist_ok=True)
+    # Forget codes that no longer exist in sites.json
+    current = {job["file_name"] for job in jobs}
+    save_manifest({name: digest for name, digest in manifest.items() if name in current})
+    print(f"{len(todo)} rendered, {len(jobs) - len(todo)} unchanged")
 
-    # Generate and save the QR code in the correct folder
-    file_name = os.path.join(location_folder, f"qr_{qr['floor']}.png")
-    qrcode.make(qr_code_url).save(file_name)
+    if args.sheets:
+        changed = {job["location"] for job in todo}
+        by_location = {}
+        for job in jobs:
+            by_location.setdefault(job["location"], []).append(job)
+        for location, location_jobs in by_location.items():
+            if location in changed or args.force or not os.path.exists(os.path.join(root_folder, location, "sheet.pdf")):
+                print(f"🖨️ Sheet saved: {render_sheet(location, location_jobs)}")
 
-    print(f"✅ QR Code saved: {file_name} → {qr_code_url}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import json
+import os
+from string import Formatter
+
+CATALOG_PATH = os.getenv("TRANSLATIONS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "translations.json"))
+DEFAULT_LANGUAGE = "English"
+
+
+class Template:
+    """ A translated string whose {placeholders} are parsed once, when the catalog is loaded. """
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = [(literal, field, spec) for literal, field, spec, _ in Formatter().parse(text)]
+        self.fields = {field for _, field, _ in self.parts if field}
+
+    def render(self, **values):
+        if not self.fields:
+            return self.text
+        out = []
+        for literal, field, spec in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(format(values[field], spec or ""))
+        return "".join(out)
+
+
+def load_catalog(path=CATALOG_PATH):
+    """ Loads {text_key: {language: text}} from a JSON file. Add a language by adding it to every entry. """
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    return {key: {language: Template(text) for language, text in entries.items()} for key, entries in raw.items()}
+
+
+CATALOG = load_catalog()
+LANGUAGES = sorted({language for entries in CATALOG.values() for language in entries})
+
+
+def lookup(text_key, language):
+    """ Returns the Template for a key (falling back to English), or None for unknown keys. """
+    entries = CATALOG.get(text_key)
+    if entries is None:
+        return None
+    return entries.get(language) or entries.get(DEFAULT_LANGUAGE)
+
+
+class UserContext:
+    """ Everything needed to talk to one user during one event, with their language resolved once. """
+
+    def __init__(self, user_id, language=DEFAULT_LANGUAGE):
+        self.user_id = user_id
+        self.language = language
+
+    def text(self, text_key):
+        """ Translated text for a key. Unknown keys (e.g. text that is already translated) are returned as is. """
+        template = lookup(text_key, self.language)
+        return template.text if template else text_key
+
+    def render(self, text_key, **values):
+        """ Translated text for a key with its placeholders filled in. """
+        template = lookup(text_key, self.language)
+        return template.render(**values) if template else text_key.format(**values)
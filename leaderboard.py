@@ -0,0 +1,188 @@
+import os
+import threading
+
+import storage
+
+POINTS_VERSION_KEY = "points_version"
+POINTS_CHANGELOG_SIZE = int(os.getenv("POINTS_CHANGELOG_SIZE", "10000"))  # changes kept for other workers to replay
+
+
+def record_points(conn, user_id, points):
+    """ Bumps points_version and logs the new points inside the caller's transaction. Returns the new version. """
+    version = storage.bump_counter(conn, POINTS_VERSION_KEY)
+    conn.execute("INSERT INTO points_changes (version, user_id, points) VALUES (?, ?, ?)", (version, user_id, points))
+    conn.execute("DELETE FROM points_changes WHERE version <= ?", (version - POINTS_CHANGELOG_SIZE,))
+    return version
+
+
+class FenwickTree:
+    """ Counts how many users have each score, with O(log N) prefix sums and k-th lookups. """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def _grow(self, score):
+        size = self.size
+        while size <= score:
+            size *= 2
+        counts = [self.count_at(s) for s in range(self.size)]
+        self.size = size
+        self.tree = [0] * (size + 1)
+        for s, count in enumerate(counts):
+            if count:
+                self.add(s, count)
+
+    def add(self, score, delta):
+        if score >= self.size:
+            self._grow(score)
+        i = score + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, score):
+        """ Number of users with a score <= `score`. """
+        if score < 0:
+            return 0
+        i = min(score + 1, self.size)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def count_at(self, score):
+        return self.prefix(score) - self.prefix(score - 1)
+
+    def kth(self, k):
+        """ Smallest score s such that prefix(s) >= k (k is 1-based). """
+        pos = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] < k:
+                pos = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return pos  # tree index pos + 1 holds score pos
+
+
+class RankIndex:
+    """ In-memory leaderboard, updated whenever a user's points change.
+
+    Users with the same points share a rank (1, 2, 2, 4, ...). The index is loaded from
+    all_user_points on first use. Changes made by other gunicorn workers (detected through the
+    points_version counter in the meta table) are replayed from the points_changes log; the
+    index is only loaded again if that log no longer reaches back far enough.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None  # None = not loaded yet
+        self._points = {}  # user_id -> points
+        self._users_by_points = {}  # points -> set of user_ids
+        self._tree = FenwickTree()
+
+    def _rebuild(self, version):
+        self._points = {}
+        self._users_by_points = {}
+        self._tree = FenwickTree()
+        for user_id, points in storage.query_all("SELECT user_id, points FROM all_user_points"):
+            self._insert(user_id, points or 0)
+        self._version = version
+
+    def _insert(self, user_id, points):
+        self._points[user_id] = points
+        self._users_by_points.setdefault(points, set()).add(user_id)
+        self._tree.add(points, 1)
+
+    def _remove(self, user_id):
+        points = self._points.pop(user_id)
+        users = self._users_by_points[points]
+        users.discard(user_id)
+        if not users:
+            del self._users_by_points[points]
+        self._tree.add(points, -1)
+
+    def _set(self, user_id, points):
+        if user_id in self._points:
+            self._remove(user_id)
+        self._insert(user_id, points)
+
+    def _refresh(self):
+        """ Catches up with points changed outside this process. Call with the lock held. """
+        version = storage.read_counter(POINTS_VERSION_KEY)
+        if version == self._version:
+            return
+        if self._version is not None and version > self._version:
+            changes = storage.query_all("""
+                SELECT version, user_id, points FROM points_changes WHERE version > ? ORDER BY version
+            """, (self._version,))
+            # Versions are handed out one by one, so the log is complete unless its start was pruned
+            if changes and changes[0][0] == self._version + 1 and changes[-1][0] - changes[0][0] == len(changes) - 1:
+                for _, user_id, points in changes:
+                    self._set(user_id, points)
+                self._version = changes[-1][0]
+                return
+        self._rebuild(version)
+
+    def apply(self, user_id, points, version):
+        """ Records a points change that was committed as `version` of the points counter. """
+        with self._lock:
+            if self._version is None or version != self._version + 1:
+                return  # not loaded yet, or behind other workers' changes: the next read catches up from the log
+            self._set(user_id, points)
+            self._version = version
+
+    def _rank(self, points):
+        return len(self._points) - self._tree.prefix(points) + 1
+
+    def _next_higher(self, points):
+        below_or_equal = self._tree.prefix(points)
+        if below_or_equal >= len(self._points):
+            return None
+        return self._tree.kth(below_or_equal + 1)
+
+    def _next_lower(self, points):
+        below = self._tree.prefix(points - 1)
+        if below == 0:
+            return None
+        return self._tree.kth(below)
+
+    def standing(self, user_id):
+        """ Returns (points, rank, above, below) for a user, or None if they have no points yet.
+
+        `above` and `below` are (points, rank) of the nearest scores above and below, or None.
+        """
+        with self._lock:
+            self._refresh()
+            points = self._points.get(user_id)
+            if points is None:
+                return None
+            higher = self._next_higher(points)
+            lower = self._next_lower(points)
+            return (
+                points,
+                self._rank(points),
+                (higher, self._rank(higher)) if higher is not None else None,
+                (lower, self._rank(lower)) if lower is not None else None,
+            )
+
+    def top(self, k):
+        """ Returns up to k (user_id, points, rank) tuples, best first. """
+        result = []
+        with self._lock:
+            self._refresh()
+            points = self._tree.kth(len(self._points)) if self._points else None
+            while points is not None and len(result) < k:
+                rank = self._rank(points)
+                for user_id in sorted(self._users_by_points[points]):
+                    if len(result) == k:
+                        break
+                    result.append((user_id, points, rank))
+                points = self._next_lower(points)
+        return result
+
+
+rank_index = RankIndex()
@@ -0,0 +1,93 @@
+import bisect
+import json
+import os
+import zlib
+
+import storage
+
+LEVELS_PATH = os.getenv("LEVELS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "levels.json"))
+CURVE_CHECKSUM_KEY = "level_curve_checksum"
+
+
+class LevelCurve:
+    """ Points -> level, as a table of breakpoints followed by a linear tail.
+
+    `breakpoints` is a list of (min_points, level) sorted by points. Past the last one, every
+    `points_per_step` more points add `levels_per_step` levels. Lookups are O(1) in the tail and a
+    bisect over the (short) table before it.
+    """
+
+    def __init__(self, breakpoints, points_per_step, levels_per_step=1):
+        self.breakpoints = [(int(points), int(level)) for points, level in sorted(breakpoints)]
+        if not self.breakpoints or self.breakpoints[0][0] != 0:
+            raise ValueError("the first breakpoint must start at 0 points")
+        if points_per_step <= 0 or levels_per_step <= 0:
+            raise ValueError("the tail must gain levels as points grow")
+        self.points_per_step = int(points_per_step)
+        self.levels_per_step = int(levels_per_step)
+        self._points = [points for points, _ in self.breakpoints]
+        self._tail_start, self._tail_level = self.breakpoints[-1]
+
+    def level(self, points):
+        """ Returns (level, points needed for the next level). """
+        if points >= self._tail_start:
+            steps = (points - self._tail_start) // self.points_per_step
+            next_threshold = self._tail_start + (steps + 1) * self.points_per_step
+            return self._tail_level + steps * self.levels_per_step, next_threshold - points
+
+        i = bisect.bisect_right(self._points, points) - 1
+        return self.breakpoints[i][1], self._points[i + 1] - points
+
+    def to_config(self):
+        return {
+            "breakpoints": [list(breakpoint) for breakpoint in self.breakpoints],
+            "points_per_step": self.points_per_step,
+            "levels_per_step": self.levels_per_step,
+        }
+
+    def checksum(self):
+        """ Changes whenever the curve does, so a stored value tells whether levels must be recomputed. """
+        return zlib.crc32(json.dumps(self.to_config(), sort_keys=True).encode("utf-8"))
+
+
+def load_curve(path=LEVELS_PATH):
+    """ Loads the level curve from a JSON config file. """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    return LevelCurve(config["breakpoints"], config["points_per_step"], config.get("levels_per_step", 1))
+
+
+level_curve = load_curve()
+
+
+def calculate_level(points, curve=None):
+    """ Returns the user's level and how many points are needed for the next level. """
+    return (curve or level_curve).level(points)
+
+
+def recompute_levels(curve=None):
+    """ Rewrites level and points_to_next_level of every user in one UPDATE. Returns the number of rows changed. """
+    curve = curve or level_curve
+    with storage.transaction() as conn:
+        conn.create_function("curve_level", 1, lambda points: curve.level(points)[0], deterministic=True)
+        conn.create_function("curve_remaining", 1, lambda points: curve.level(points)[1], deterministic=True)
+        changed = conn.execute("""
+            UPDATE all_user_points
+            SET level = curve_level(points), points_to_next_level = curve_remaining(points)
+            WHERE level IS NOT curve_level(points) OR points_to_next_level IS NOT curve_remaining(points)
+        """).rowcount
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (CURVE_CHECKSUM_KEY, curve.checksum()))
+    return changed
+
+
+def sync_levels(curve=None):
+    """ Recomputes stored levels if the curve changed since the last run. Returns the number of rows changed. """
+    curve = curve or level_curve
+    if storage.read_counter(CURVE_CHECKSUM_KEY) == curve.checksum():
+        return 0
+    return recompute_levels(curve)
+
+
+if __name__ == "__main__":
+    storage.init_db()
+    print(f"✅ Recomputed levels for {recompute_levels()} users")
@@ -0,0 +1,111 @@
+"""Local stand-in for the LINE Messaging API, for trying the bot without a real channel.
+
+    python line_stub.py --port 8080 --fail-rate 0.1 --rate-limit-every 20
+    LINE_API_ENDPOINT=http://127.0.0.1:8080 LINE_API_DATA_ENDPOINT=http://127.0.0.1:8080 python app.py
+
+GET /__stats returns how many calls each endpoint received.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LineStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload=None, headers=None):
+        body = json.dumps(payload if payload is not None else {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+
+    def _handle(self, method):
+        server = self.server
+        body = self._read_body() if method in ("POST", "PUT") else {}
+        path = self.path.split("?", 1)[0]
+
+        if path == "/__stats":
+            with server.lock:
+                return self._send(200, dict(server.calls))
+
+        with server.lock:
+            server.calls[f"{method} {path}"] += 1
+            server.total += 1
+            count = server.total
+            server.messages.extend(body.get("messages", []))
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.rate_limit_every and count % server.rate_limit_every == 0:
+            return self._send(429, {"message": "The API rate limit has been exceeded."}, {"Retry-After": "1"})
+        if random.random() < server.fail_rate:
+            return self._send(500, {"message": "Internal server error"})
+
+        if path.startswith("/v2/bot/profile/"):
+            user_id = path.rsplit("/", 1)[1]
+            return self._send(200, {"userId": user_id, "displayName": f"Climber {user_id[-4:]}",
+                                    "pictureUrl": "", "statusMessage": ""})
+        if path == "/v2/bot/richmenu":
+            return self._send(200, {"richMenuId": "richmenu-0000"})
+        if path.startswith("/geolocation/v1/geolocate"):
+            return self._send(200, {"location": {"lat": 25.0216448, "lng": 121.5496192}, "accuracy": 20})
+        return self._send(200, {})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def make_server(host="127.0.0.1", port=8080, fail_rate=0.0, rate_limit_every=0, latency=0.0):
+    """ Creates (but does not start) a stub server. Call serve_forever() on the result. """
+    server = ThreadingHTTPServer((host, port), LineStubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = Counter()
+    server.messages = []
+    server.total = 0
+    server.fail_rate = fail_rate
+    server.rate_limit_every = rate_limit_every
+    server.latency = latency
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local LINE Messaging API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of calls answered with 500")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth call with 429")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering")
+    args = parser.parse_args()
+
+    stub = make_server(args.host, args.port, args.fail_rate, args.rate_limit_every, args.latency)
+    print(f"✅ LINE API stub listening on http://{args.host}:{args.port}")
+    stub.serve_forever()
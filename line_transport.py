@@ -0,0 +1,187 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from linebot import LineBotApi
+from linebot.http_client import HttpClient, RequestsHttpResponse
+
+from metrics import OUTBOUND_LATENCY, OUTBOUND_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Point these at a local stub (see line_stub.py) to run without talking to LINE
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")
+LINE_API_DATA_ENDPOINT = os.getenv("LINE_API_DATA_ENDPOINT", "https://api-data.line.me")
+
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", os.getenv("WEBHOOK_WORKERS", "4")))
+LINE_CONNECT_TIMEOUT = float(os.getenv("LINE_CONNECT_TIMEOUT", "3.05"))
+LINE_READ_TIMEOUT = float(os.getenv("LINE_READ_TIMEOUT", "10"))
+LINE_MAX_RETRIES = int(os.getenv("LINE_MAX_RETRIES", "3"))
+LINE_RATE_LIMIT = float(os.getenv("LINE_RATE_LIMIT", "200"))  # requests per second
+
+RETRY_BASE_DELAY = 0.2  # seconds, doubled on every attempt
+RETRY_MAX_DELAY = 5.0
+
+# Endpoints that accept X-Line-Retry-Key, so retrying them can never send a message twice.
+# Other POSTs (e.g. reply) are only retried when they never reached LINE.
+RETRY_KEY_PATHS = ("/v2/bot/message/push", "/v2/bot/message/multicast",
+                   "/v2/bot/message/narrowcast", "/v2/bot/message/broadcast")
+
+_ID_SEGMENT = re.compile(r"/(U[0-9a-f]{32}|richmenu-[0-9a-f]+|\d+)(?=/|$)")
+
+
+class TokenBucket:
+    """ Client-side rate limiter: allows `rate` requests per second with bursts up to `capacity`. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a request may be sent. """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ Stops all requests for `seconds` (used when the server answers 429). """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class PooledHttpClient(HttpClient):
+    """ LINE SDK transport with a keep-alive connection pool, retries with backoff and a rate limiter. """
+
+    def __init__(self, timeout=None, pool_size=LINE_HTTP_POOL_SIZE, max_retries=LINE_MAX_RETRIES,
+                 rate_limit=LINE_RATE_LIMIT):
+        super().__init__(timeout or (LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT))
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+    def _request(self, method, url, headers=None, timeout=None, **kwargs):
+        path = urlparse(url).path
+        endpoint = f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+        headers = dict(headers or {})
+        if method == "POST" and path in RETRY_KEY_PATHS:
+            headers.setdefault("X-Line-Retry-Key", str(uuid.uuid4()))
+        repeatable = method == "GET" or path in RETRY_KEY_PATHS  # safe to send again after LINE may have seen it
+
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            started_at = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers=headers,
+                                                timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(endpoint, time.monotonic() - started_at, error=True)
+                if attempt >= self.max_retries or not (repeatable or self._not_sent(e)):
+                    raise
+                logger.warning(f"🚨 {endpoint} failed ({e}), retrying")
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            status = response.status_code
+            self._record(endpoint, time.monotonic() - started_at, error=status >= 400)
+
+            if status == 429 and attempt < self.max_retries:
+                delay = self._retry_after(response) or self._backoff(attempt)
+                logger.warning(f"🚨 {endpoint} rate limited, waiting {delay:.2f}s")
+                self.bucket.pause(delay)
+                attempt += 1
+                continue
+            if status >= 500 and repeatable and attempt < self.max_retries:
+                logger.warning(f"🚨 {endpoint} returned {status}, retrying")
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            return RequestsHttpResponse(response)
+
+    @staticmethod
+    def _backoff(attempt):
+        """ Exponential backoff with full jitter. """
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    @staticmethod
+    def _not_sent(error):
+        """ True if the request failed while connecting, i.e. LINE never received it. """
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+
+    def _record(self, endpoint, seconds, error):
+        OUTBOUND_LATENCY.labels(service="line", endpoint=endpoint).observe(seconds)
+        if error:
+            OUTBOUND_ERRORS.labels(service="line", endpoint=endpoint).inc()
+
+    def stats(self):
+        """ Per-endpoint request, error and latency counters (histograms are in /metrics). """
+        errors = {key: child.value for key, child in OUTBOUND_ERRORS.children()}
+        return {
+            endpoint: {
+                "requests": child.count,
+                "errors": int(errors.get((service, endpoint), 0)),
+                "avg_ms": round(child.sum / child.count * 1000, 2) if child.count else 0.0,
+            }
+            for (service, endpoint), child in OUTBOUND_LATENCY.children() if service == "line"
+        }
+
+
+# One transport per process, shared by every LineBotApi built here
+http_client = PooledHttpClient()
+
+
+def make_line_bot_api(access_token, endpoint=LINE_API_ENDPOINT, data_endpoint=LINE_API_DATA_ENDPOINT):
+    """ Builds a LineBotApi that sends everything through the shared pooled transport. """
+    return LineBotApi(
+        access_token,
+        endpoint=endpoint,
+        data_endpoint=data_endpoint,
+        http_client=lambda timeout: http_client,
+    )
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from cache import LRUCache, MISSING
+from metrics import OUTBOUND_LATENCY, OUTBOUND_ERRORS
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+GOOGLE_GEOLOCATION_URL = os.getenv("GOOGLE_GEOLOCATION_URL", "https://www.googleapis.com/geolocation/v1/geolocate")
+GEOLOCATION_TIMEOUT = (1.0, 2.0)  # (connect, read) seconds
+
+LOCATION_TTL = float(os.getenv("LOCATION_TTL", "600"))  # how long a shared position stays valid, in seconds
+LOCATION_CACHE_SIZE = int(os.getenv("LOCATION_CACHE_SIZE", "10000"))
+
+# Comma-separated verification stages, tried in order. "google" is opt-in: it locates the server
+# making the request, not the user, so it cannot prove that anyone stands in a staircase.
+LOCATION_VERIFIERS = os.getenv("LOCATION_VERIFIERS", "user_position")
+
+
+class CircuitBreaker:
+    """ Stops calling a failing service for `reset_timeout` seconds after `failure_threshold` failures in a row. """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """ True if a call may go through (closed, or half-open and due for a trial call). """
+        with self._lock:
+            state = self.state
+            if state == "half-open":
+                self.opened_at = time.monotonic()  # only one trial call per reset period
+            return state != "open"
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class UserPositionStage:
+    """ Uses the position the user shared with a LocationMessage, while it is recent enough. """
+
+    name = "user_position"
+
+    def __init__(self, positions):
+        self.positions = positions
+
+    def locate(self, user_id):
+        position = self.positions.get(user_id)
+        return None if position is MISSING else position
+
+
+class GoogleGeolocationStage:
+    """ Asks Google's Geolocation API, with strict timeouts and a circuit breaker. """
+
+    name = "google"
+
+    def __init__(self, api_key=GOOGLE_API_KEY, url=GOOGLE_GEOLOCATION_URL, breaker=None):
+        self.api_key = api_key
+        self.url = url
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+
+    def locate(self, user_id):
+        if not self.api_key or not self.breaker.allow():
+            return None
+        started = time.perf_counter()
+        try:
+            response = self.session.post(f"{self.url}?key={self.api_key}", json={}, timeout=GEOLOCATION_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            OUTBOUND_ERRORS.labels(service="google", endpoint="geolocate").inc()
+            self.breaker.record_failure()
+            logger.warning(f"🚨 Error fetching location: {e}")
+            return None
+        finally:
+            OUTBOUND_LATENCY.labels(service="google", endpoint="geolocate").observe(time.perf_counter() - started)
+        self.breaker.record_success()
+        return data["location"]["lat"], data["location"]["lng"]
+
+
+class LocationVerifier:
+    """ Finds a position to check a QR scan against, trying each configured stage in order. """
+
+    def __init__(self, stage_names=LOCATION_VERIFIERS):
+        self.positions = LRUCache(maxsize=LOCATION_CACHE_SIZE, ttl=LOCATION_TTL)
+        available = {
+            UserPositionStage.name: lambda: UserPositionStage(self.positions),
+            GoogleGeolocationStage.name: GoogleGeolocationStage,
+        }
+        self.stages = [available[name.strip()]() for name in stage_names.split(",") if name.strip()]
+        self.resolved_by = {stage.name: 0 for stage in self.stages}
+        self.unresolved = 0
+
+    def remember(self, user_id, lat, lng):
+        """ Stores a position the user shared, valid for LOCATION_TTL seconds. """
+        self.positions.set(user_id, (lat, lng))
+
+    def locate(self, user_id):
+        """ Returns (lat, lng) or None if no stage could tell where the user is. """
+        for stage in self.stages:
+            position = stage.locate(user_id)
+            if position is not None:
+                self.resolved_by[stage.name] += 1
+                return position
+        self.unresolved += 1
+        return None
+
+    def stats(self):
+        stats = {"resolved_by": dict(self.resolved_by), "unresolved": self.unresolved, "positions": self.positions.stats()}
+        for stage in self.stages:
+            if isinstance(stage, GoogleGeolocationStage):
+                stats["google_breaker"] = stage.breaker.state
+        return stats
+
+
+location_verifier = LocationVerifier()
@@ -0,0 +1,230 @@
+import bisect
+import functools
+import threading
+import time
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        """ Returns the child metric for one combination of label values. """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        return self.labels() if not self.labelnames else None
+
+    def children(self):
+        if self.collect is not None:
+            try:
+                collected = self.collect()
+            except Exception:
+                return []  # a failing collector must not break the whole scrape
+            if not isinstance(collected, dict):
+                collected = {(): collected}
+            for key, value in collected.items():
+                key = key if isinstance(key, tuple) else (key,)
+                self.labels(**dict(zip(self.labelnames, key))).set(value)
+        return list(self._children.items())
+
+    @property
+    def family(self):
+        """ The name the HELP and TYPE lines use, which must match the sample names. """
+        return self.name
+
+    def render(self):
+        lines = [f"# HELP {self.family} {self.documentation}", f"# TYPE {self.family} {self.kind}"]
+        for key, child in sorted(self.children()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    """ A value that only goes up. Pass `collect` to read a total kept elsewhere (e.g. in the database) at scrape time. """
+
+    kind = "counter"
+
+    @property
+    def family(self):
+        return f"{self.name}_total"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _render_child(self, key, child):
+        return [f"{self.family}{_format_labels(self.labelnames, key)} {child.value}"]
+
+
+class Gauge(_Metric):
+    """ A value that goes up and down. Pass `collect` to compute it at scrape time instead of setting it. """
+
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {child.value}"]
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def time(self):
+        return timed(self)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, seconds):
+        self._default().observe(seconds)
+
+    def _render_child(self, key, child):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class timed:
+    """ Records how long something takes into a histogram (child). Works as a decorator and as a context manager:
+
+        @timed(HANDLER_LATENCY.labels(handler="handle_qr_scan"))
+        def handle_qr_scan(...): ...
+
+        with timed(SQL_LATENCY.labels(statement="SELECT scans")):
+            ...
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._local = threading.local()
+
+    def __enter__(self):
+        starts = getattr(self._local, "starts", None)
+        if starts is None:
+            starts = self._local.starts = []
+        starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self._local.starts.pop())
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format. """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=(), collect=None):
+    return registry.register(Counter(name, documentation, labelnames, collect))
+
+
+def gauge(name, documentation, labelnames=(), collect=None):
+    return registry.register(Gauge(name, documentation, labelnames, collect))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Metrics shared by several modules
+HANDLER_LATENCY = histogram("staircase_handler_seconds", "Time spent in each bot handler", ["handler"])
+SQL_LATENCY = histogram("staircase_sql_seconds", "Time spent executing SQL statements, by kind and table", ["statement"])
+SQL_ROWS = counter("staircase_sql_rows", "Rows returned or changed by SQL statements, by kind and table", ["statement"])
+OUTBOUND_LATENCY = histogram("staircase_outbound_request_seconds", "Latency of calls to external APIs", ["service", "endpoint"])
+OUTBOUND_ERRORS = counter("staircase_outbound_errors", "Failed calls to external APIs", ["service", "endpoint"])
+
+
+def time_handler(func):
+    """ Decorator recording a bot handler's latency under its function name. """
+    return timed(HANDLER_LATENCY.labels(handler=func.__name__))(func)
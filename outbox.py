@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from linebot.exceptions import LineBotApiError
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGES_PER_CALL = 5  # LINE accepts at most 5 messages per reply/push call
+REPLY_TOKEN_TTL = 50  # seconds; LINE reply tokens expire about a minute after the event
+
+
+class Outbox:
+    """ Collects everything a handler wants to say during one event and sends it in as few calls as possible.
+
+    Inside `collect(event)` messages are buffered and sent with a single `reply_message`
+    call when the event is done. Outside of an event they are pushed right away.
+    """
+
+    def __init__(self, line_bot_api):
+        self.line_bot_api = line_bot_api
+        self._local = threading.local()
+
+    @contextmanager
+    def collect(self, event):
+        """ Buffers the messages sent while handling `event`, then flushes them. """
+        source = getattr(event, "source", None)
+        batch = {
+            "user_id": getattr(source, "user_id", None),
+            "event_id": getattr(event, "webhook_event_id", None),
+            "reply_token": getattr(event, "reply_token", None),
+            "timestamp": getattr(event, "timestamp", None),
+            "messages": [],
+        }
+        previous = getattr(self._local, "batch", None)
+        self._local.batch = batch
+        try:
+            yield
+        finally:
+            self._local.batch = previous
+            self.flush(batch)
+
+    def send(self, user_id, message):
+        """ Queues a message for the current event, or pushes it if there is no event for this user. """
+        batch = getattr(self._local, "batch", None)
+        if batch is not None and batch["user_id"] == user_id:
+            batch["messages"].append(message)
+            return
+        self._push(user_id, [message])
+
+    def flush(self, batch):
+        """ Sends a batch: up to 5 messages as a reply, anything else (or everything, if the token is unusable) as pushes. """
+        messages = batch["messages"]
+        if not messages:
+            return
+
+        if self._reply_token_usable(batch):
+            try:
+                self.line_bot_api.reply_message(batch["reply_token"], messages[:MAX_MESSAGES_PER_CALL])
+                messages = messages[MAX_MESSAGES_PER_CALL:]
+            except LineBotApiError as e:
+                if not _invalid_reply_token(e):
+                    logger.error(f"🚨 Reply to event {batch['event_id']} of {batch['user_id']} failed: {e}")
+                    raise
+                logger.warning(f"🚨 Reply token of event {batch['event_id']} was rejected, pushing instead: {e}")
+            except Exception:
+                logger.exception(f"🚨 Reply to event {batch['event_id']} of {batch['user_id']} failed")
+                raise
+
+        if messages and batch["user_id"]:
+            self._push(batch["user_id"], messages)
+
+    def _reply_token_usable(self, batch):
+        if not batch["reply_token"]:
+            return False
+        if batch["timestamp"] is None:
+            return True
+        return time.time() - batch["timestamp"] / 1000 < REPLY_TOKEN_TTL
+
+    def _push(self, user_id, messages):
+        for i in range(0, len(messages), MAX_MESSAGES_PER_CALL):
+            try:
+                self.line_bot_api.push_message(user_id, messages[i:i + MAX_MESSAGES_PER_CALL])
+            except Exception:
+                logger.exception(f"🚨 Push to {user_id} failed")
+                raise
+
+
+def _invalid_reply_token(error):
+    """ True if LINE rejected the reply because its token is invalid, expired or already used. """
+    message = getattr(getattr(error, "error", None), "message", "") or ""
+    return error.status_code == 400 and "reply token" in message.lower()
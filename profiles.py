@@ -0,0 +1,126 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from linebot.exceptions import LineBotApiError
+
+import storage
+from cache import LRUCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_TTL = float(os.getenv("PROFILE_TTL", str(7 * 24 * 3600)))  # seconds before a name is fetched again
+PROFILE_REFRESH_QUEUE = int(os.getenv("PROFILE_REFRESH_QUEUE", "1000"))
+MAX_NAME_LENGTH = 20  # longer display names are cut, to keep leaderboard lines short
+
+
+class ProfileCache:
+    """ LINE display names, kept in the user_profiles table with an in-memory LRU in front of it.
+
+    Profiles are stored when a user follows the bot. Reads never call the LINE API: a missing or
+    older than PROFILE_TTL profile is returned as it is (or as None) and fetched again by a
+    background thread, so the next read has it.
+    """
+
+    def __init__(self, line_bot_api, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_TTL, max_queue=PROFILE_REFRESH_QUEUE):
+        self.line_bot_api = line_bot_api
+        self.ttl = ttl
+        self.cache = LRUCache(maxsize=maxsize)  # user_id -> (display_name, fetched_at)
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._queue = None
+        self._queued = set()  # user ids waiting for a refresh, so each is fetched once
+        self._pid = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def store(self, user_id, display_name, picture_url=None):
+        """ Saves a freshly fetched profile (e.g. the one handle_follow got anyway). """
+        fetched_at = int(time.time())
+        storage.execute("""
+            INSERT INTO user_profiles (user_id, display_name, picture_url, fetched_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+            display_name = excluded.display_name, picture_url = excluded.picture_url, fetched_at = excluded.fetched_at
+        """, (user_id, display_name or "", picture_url, fetched_at))
+        self.cache.set(user_id, (display_name or "", fetched_at))
+
+    def names(self, user_ids):
+        """ Returns {user_id: display name or None} from the cache and the table, scheduling refreshes as needed. """
+        entries, missing = {}, []
+        for user_id in user_ids:
+            entry = self.cache.get(user_id)
+            if entry is MISSING:
+                missing.append(user_id)
+            else:
+                entries[user_id] = entry
+
+        if missing:
+            rows = storage.query_all(f"""
+                SELECT user_id, display_name, fetched_at FROM user_profiles WHERE user_id IN ({", ".join("?" * len(missing))})
+            """, missing)
+            for user_id, display_name, fetched_at in rows:
+                entries[user_id] = (display_name, fetched_at)
+                self.cache.set(user_id, entries[user_id])
+
+        now = time.time()
+        for user_id in user_ids:
+            entry = entries.get(user_id)
+            if entry is None or now - entry[1] >= self.ttl:
+                self._schedule(user_id)
+        return {user_id: _short(entries[user_id][0]) if user_id in entries else None for user_id in user_ids}
+
+    def _schedule(self, user_id):
+        """ Queues a background fetch of the profile, unless one is already queued or the queue is full. """
+        with self._lock:
+            if self._pid != os.getpid():
+                # One refresh thread per process, started inside each gunicorn worker
+                self._pid = os.getpid()
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                self._queued = set()
+                threading.Thread(target=self._run, args=(self._queue,), name="profile-refresh", daemon=True).start()
+            if user_id in self._queued:
+                return
+            try:
+                self._queue.put_nowait(user_id)
+            except queue.Full:
+                return
+            self._queued.add(user_id)
+
+    def _run(self, q):
+        while True:
+            user_id = q.get()
+            try:
+                self.refresh(user_id)
+            finally:
+                with self._lock:
+                    self._queued.discard(user_id)
+
+    def refresh(self, user_id):
+        """ Fetches one profile from LINE and stores it. """
+        try:
+            profile = self.line_bot_api.get_profile(user_id)
+        except LineBotApiError as e:
+            self.failures += 1
+            if e.status_code == 404:
+                self.store(user_id, "")  # blocked the bot or left: no name, and no new attempt before the TTL
+            else:
+                logger.warning(f"🚨 Could not fetch the profile of {user_id}: {e}")
+            return
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"🚨 Could not fetch the profile of {user_id}: {e}")
+            return
+        self.refreshes += 1
+        self.store(user_id, profile.display_name, profile.picture_url)
+
+    def stats(self):
+        return {**self.cache.stats(), "queued": len(self._queued), "refreshes": self.refreshes, "failures": self.failures}
+
+
+def _short(name):
+    if not name:
+        return None
+    return name if len(name) <= MAX_NAME_LENGTH else name[:MAX_NAME_LENGTH - 1] + "…"
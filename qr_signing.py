@@ -0,0 +1,46 @@
+import base64
+import hashlib
+import hmac
+import os
+
+QR_PREFIX = "STAIRCASE_QR_"
+
+# Secret shared by generate_qrcode.py and the bot. Without it, codes are generated unsigned.
+QR_SECRET = os.getenv("QR_SECRET", "")
+# Bump QR_EPOCH and reprint to rotate codes; codes from the previous epoch keep working until the next bump
+QR_EPOCH = int(os.getenv("QR_EPOCH", "0"))
+# Accept the old unsigned STAIRCASE_QR_{floor}_{location} codes while they are being replaced (opt-in once a secret is set)
+ALLOW_UNSIGNED_QR = os.getenv("ALLOW_UNSIGNED_QR", "0" if QR_SECRET else "1") == "1"
+
+TAG_BYTES = 8  # 64-bit tag, 13 base32 characters
+
+
+def _tag(floor, location, epoch, secret):
+    digest = hmac.new(secret.encode("utf-8"), f"{floor}|{location}|{epoch}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.b32encode(digest[:TAG_BYTES]).decode("ascii").rstrip("=").lower()
+
+
+def make_payload(floor, location, epoch=QR_EPOCH, secret=QR_SECRET):
+    """ Text encoded in a QR code: STAIRCASE_QR_{floor}_{location}_{epoch}_{tag}, or the unsigned form without a secret. """
+    if not secret:
+        return f"{QR_PREFIX}{floor}_{location}"
+    return f"{QR_PREFIX}{floor}_{location}_{epoch}_{_tag(floor, location, epoch, secret)}"
+
+
+def parse_payload(message, secret=QR_SECRET, epoch=QR_EPOCH, allow_unsigned=ALLOW_UNSIGNED_QR):
+    """ Returns (floor, location) for a genuine QR payload, or None if it is malformed or forged. """
+    if not message.startswith(QR_PREFIX):
+        return None
+    # Floors never contain "_" and the epoch and tag are always the last two fields, so locations may
+    floor, _, rest = message[len(QR_PREFIX):].partition("_")
+    if not floor or not rest:
+        return None
+
+    fields = rest.rsplit("_", 2)
+    if secret and len(fields) == 3 and fields[1].isdigit():
+        location, code_epoch, tag = fields
+        if int(code_epoch) in (epoch, epoch - 1) and hmac.compare_digest(tag, _tag(floor, location, int(code_epoch), secret)):
+            return floor, location
+
+    # Anything else is read as an unsigned STAIRCASE_QR_{floor}_{location} code
+    return (floor, rest) if allow_unsigned or not secret else None
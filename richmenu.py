@@ -1,10 +1,10 @@
 import os
 import json
-from linebot import LineBotApi
+from line_transport import make_line_bot_api
 from linebot.models import RichMenu, RichMenuSize, RichMenuArea, RichMenuBounds, PostbackAction, URITemplateAction
 
 LINE_ACCESS_TOKEN = os.getenv("LINE_ACCESS_TOKEN", "YOUR_ACCESS_TOKEN_HERE")
-line_bot_api = LineBotApi(LINE_ACCESS_TOKEN)
+line_bot_api = make_line_bot_api(LINE_ACCESS_TOKEN)
 
 def create_rich_menu():
     """Create a rich menu with six sections"""
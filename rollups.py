@@ -0,0 +1,154 @@
+"""Per-day and per-month rollups of scans, and the period leaderboards read from them.
+
+    python rollups.py --month 2025-03 --top 10
+
+prints the top climbers and buildings of a month (e.g. to pick the monthly reward winners).
+"""
+import argparse
+import datetime
+
+import storage
+from leaderboard import rank_index
+
+PERIODS = ("week", "month", "all")
+ROLLUPS_BACKFILLED_KEY = "rollups_backfilled"
+
+
+def day_key(when):
+    return when.strftime("%Y-%m-%d")
+
+
+def month_key(when):
+    return when.strftime("%Y-%m")
+
+
+def week_days(when):
+    """ First and last day (Monday to Sunday) of the week containing `when`. """
+    monday = when.date() - datetime.timedelta(days=when.weekday())
+    return day_key(monday), day_key(monday + datetime.timedelta(days=6))
+
+
+def record_scans(conn, scans):
+    """ Adds written scans to the rollups, inside the caller's transaction.
+
+    `scans` is a list of (user_id, location, scan_time, count, floors, points), where floors and points
+    are the totals of `count` scans. Rows are aggregated per bucket first, so a batch costs one upsert
+    per (bucket, user) instead of one per scan.
+    """
+    daily, monthly, buildings = {}, {}, {}
+    for user_id, location, scan_time, count, floors, points in scans:
+        for buckets, key in ((daily, (day_key(scan_time), user_id)), (monthly, (month_key(scan_time), user_id))):
+            totals = buckets.setdefault(key, [0, 0, 0])
+            totals[0] += count
+            totals[1] += floors
+            totals[2] += points
+        totals = buildings.setdefault((month_key(scan_time), location), [0, 0])
+        totals[0] += count
+        totals[1] += floors
+
+    for table, period, rows in (("user_daily_stats", "day", daily), ("user_monthly_stats", "month", monthly)):
+        conn.executemany(f"""
+            INSERT INTO {table} ({period}, user_id, scans, floors, points) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT({period}, user_id) DO UPDATE SET
+            scans = scans + excluded.scans, floors = floors + excluded.floors, points = points + excluded.points
+        """, [(*key, *totals) for key, totals in rows.items()])
+    conn.executemany("""
+        INSERT INTO building_monthly_stats (month, location, scans, floors) VALUES (?, ?, ?, ?)
+        ON CONFLICT(month, location) DO UPDATE SET scans = scans + excluded.scans, floors = floors + excluded.floors
+    """, [(*key, *totals) for key, totals in buildings.items()])
+
+
+def backfill_rollups(points_per_scan=1):
+    """ One-off: builds the rollups from the existing scans (raw and compacted). """
+    with storage.transaction() as conn:
+        if conn.execute("SELECT 1 FROM meta WHERE key = ?", (ROLLUPS_BACKFILLED_KEY,)).fetchone():
+            return
+
+        for table in ("user_daily_stats", "user_monthly_stats", "building_monthly_stats"):
+            conn.execute(f"DELETE FROM {table}")
+
+        scans = []
+        for user_id, location, day, count, floors in conn.execute("""
+            SELECT h.user_id, COALESCE(s.name, ''), h.day, SUM(h.scans), SUM((h.floor_to - h.floor_from) * h.scans)
+            FROM scan_history h LEFT JOIN sites s ON s.id = h.site_id
+            GROUP BY h.user_id, h.site_id, h.day
+        """):
+            try:
+                when = datetime.datetime.strptime(day, "%Y-%m-%d")
+            except (ValueError, TypeError):
+                continue  # legacy rows whose time could not be read
+            scans.append((user_id, location, when, count, floors or 0, points_per_scan * count))
+        record_scans(conn, scans)
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, 1)", (ROLLUPS_BACKFILLED_KEY,))
+
+
+def _period_totals(period, now):
+    """ SQL returning (user_id, points) for every user with points in the period, and its parameters. """
+    if period == "month":
+        return "SELECT user_id, points FROM user_monthly_stats WHERE month = ?", (month_key(now),)
+    if period == "week":
+        return """
+            SELECT user_id, SUM(points) AS points FROM user_daily_stats
+            WHERE day BETWEEN ? AND ? GROUP BY user_id
+        """, week_days(now)
+    raise ValueError(f"unknown period {period!r}")
+
+
+def top(period, k=3, now=None):
+    """ Returns up to k (user_id, points, rank) for the period, best first. Users with equal points share a rank. """
+    if period == "all":
+        return rank_index.top(k)
+
+    sql, params = _period_totals(period, now or datetime.datetime.now())
+    rows = storage.query_all(f"SELECT user_id, points FROM ({sql}) WHERE points > 0 ORDER BY points DESC, user_id LIMIT ?",
+                             (*params, k))
+    result = []
+    for i, (user_id, points) in enumerate(rows):
+        rank = result[-1][2] if result and result[-1][1] == points else i + 1
+        result.append((user_id, points, rank))
+    return result
+
+
+def standing(user_id, period, now=None):
+    """ Returns (points, rank) of a user in the period, or None if they have no points in it. """
+    if period == "all":
+        overall = rank_index.standing(user_id)
+        return overall[:2] if overall else None
+
+    now = now or datetime.datetime.now()
+    if period == "month":
+        row = storage.query_one("SELECT points FROM user_monthly_stats WHERE month = ? AND user_id = ?",
+                                (month_key(now), user_id))
+    else:
+        row = storage.query_one("SELECT SUM(points) FROM user_daily_stats WHERE day BETWEEN ? AND ? AND user_id = ?",
+                                (*week_days(now), user_id))
+    if not row or not row[0]:
+        return None
+
+    sql, params = _period_totals(period, now)
+    above = storage.query_one(f"SELECT COUNT(*) FROM ({sql}) WHERE points > ?", (*params, row[0]))[0]
+    return row[0], above + 1
+
+
+def building_totals(month):
+    """ Returns (location, scans, floors) for every building scanned in the month ("YYYY-MM"), busiest first. """
+    return storage.query_all("""
+        SELECT location, scans, floors FROM building_monthly_stats WHERE month = ? ORDER BY floors DESC, location
+    """, (month,))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Top climbers and buildings of a month")
+    parser.add_argument("--month", default=month_key(datetime.datetime.now()), help="YYYY-MM (default: this month)")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    storage.init_db()
+    backfill_rollups()
+    now = datetime.datetime.strptime(args.month, "%Y-%m")
+    print(f"🏆 Top climbers of {args.month}")
+    for user_id, points, rank in top("month", args.top, now):
+        print(f"{rank:>4}. {user_id} {points} points")
+    print(f"\n🏢 Buildings in {args.month}")
+    for location, scans, floors in building_totals(args.month):
+        print(f"  {location}: {scans} scans, {floors} floors")
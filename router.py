@@ -0,0 +1,109 @@
+import metrics
+
+ROUTE_LATENCY = metrics.histogram("staircase_route_seconds", "Time spent handling each postback / text command route", ["route"])
+
+_END = "\0"  # marks the end of a registered prefix in the trie
+
+
+class Route:
+    def __init__(self, name, func, pass_payload):
+        self.name = name
+        self.func = func
+        self.pass_payload = pass_payload
+        self.latency = ROUTE_LATENCY.labels(route=name)
+
+    def __call__(self, ctx, payload):
+        with metrics.timed(self.latency):
+            if self.pass_payload:
+                return self.func(ctx, payload)
+            return self.func(ctx)
+
+
+class PrefixTrie:
+    """ Finds the longest registered prefix of a string in O(length of the prefix). """
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[_END] = value
+
+    def longest_prefix(self, text):
+        node, found = self.root, None
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if _END in node:
+                found = node[_END]
+        return found
+
+
+class Router:
+    """ Declarative dispatch for postbacks (exact match, then prefix) and text commands (prefix trie). """
+
+    def __init__(self):
+        self.routes = []
+        self._postbacks = {}
+        self._postback_prefixes = PrefixTrie()
+        self._text_exact_case = PrefixTrie()
+        self._text = PrefixTrie()
+        self._default_text = None
+
+    def _route(self, name, func, pass_payload):
+        route = Route(name, func, pass_payload)
+        self.routes.append(route)
+        return route
+
+    def postback(self, data, func, pass_payload=False):
+        """ Routes a postback whose data is exactly `data`. """
+        self._postbacks[data] = self._route(f"postback:{data}", func, pass_payload)
+
+    def postback_prefix(self, prefix, func):
+        """ Routes postbacks starting with `prefix`; func gets the full data as second argument. """
+        self._postback_prefixes.insert(prefix, self._route(f"postback:{prefix}*", func, True))
+
+    def text(self, prefixes, func, pass_payload=False, case_sensitive=False):
+        """ Routes text messages starting with any of `prefixes`.
+
+        Case-insensitive prefixes are matched against the stripped, lower-cased message.
+        Case-sensitive ones are matched against the raw message and take precedence.
+        """
+        route = self._route(f"text:{prefixes[0]}", func, pass_payload)
+        for prefix in prefixes:
+            if case_sensitive:
+                self._text_exact_case.insert(prefix, route)
+            else:
+                self._text.insert(prefix.lower(), route)
+
+    def default_text(self, func):
+        """ Handles text messages that match no command. """
+        self._default_text = self._route("text:default", func, False)
+
+    def dispatch_postback(self, ctx, data):
+        """ Runs the route for a postback. Returns False if nothing matched. """
+        route = self._postbacks.get(data) or self._postback_prefixes.longest_prefix(data)
+        if route is None:
+            return False
+        route(ctx, data)
+        return True
+
+    def dispatch_text(self, ctx, text):
+        """ Runs the route for a text message, falling back to the default route. """
+        route = (self._text_exact_case.longest_prefix(text)
+                 or self._text.longest_prefix(text.strip().lower())
+                 or self._default_text)
+        if route is None:
+            return False
+        route(ctx, text)
+        return True
+
+    def stats(self):
+        """ Call count and average latency of every route that was called at least once (histograms are in /metrics). """
+        return {
+            route.name: {"calls": route.latency.count, "avg_ms": round(route.latency.sum / route.latency.count * 1000, 2)}
+            for route in self.routes if route.latency.count
+        }
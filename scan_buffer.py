@@ -0,0 +1,327 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import metrics
+import storage
+from leaderboard import rank_index, record_points
+from levels import calculate_level
+from rollups import record_scans
+from sites import parse_floor
+
+logger = logging.getLogger(__name__)
+
+TOTAL_FLOORS_KEY = "total_floors_climbed"
+
+# A flush happens every WRITE_BUFFER_FLUSH_MS milliseconds, or as soon as WRITE_BUFFER_MAX_RECORDS scans are waiting.
+# WRITE_BUFFER_FLUSH_MS=0 writes every scan before answering, like before.
+WRITE_BUFFER_FLUSH_MS = float(os.getenv("WRITE_BUFFER_FLUSH_MS", "50"))
+WRITE_BUFFER_MAX_RECORDS = int(os.getenv("WRITE_BUFFER_MAX_RECORDS", "200"))
+WRITE_BUFFER_JOURNAL_DIR = os.getenv("WRITE_BUFFER_JOURNAL_DIR", os.path.dirname(os.path.abspath(storage.DB_PATH)))
+
+FLUSH_LATENCY = metrics.histogram("staircase_write_buffer_flush_seconds", "Time spent committing one batch of buffered scans")
+FLUSHED_SCANS = metrics.counter("staircase_write_buffer_scans", "Buffered scans written or dropped by the cooldown guard", ["result"])
+
+
+class ScanRecord:
+    __slots__ = ("user_id", "floor", "location", "scan_time", "floors", "points", "written")
+
+    def __init__(self, user_id, floor, location, scan_time, floors, points):
+        self.user_id = user_id
+        self.floor = floor
+        self.location = location
+        self.scan_time = scan_time
+        self.floors = floors
+        self.points = points
+        self.written = False
+
+    def to_json(self):
+        return json.dumps([self.user_id, self.floor, self.location, self.scan_time.isoformat(), self.floors, self.points],
+                          ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, line):
+        user_id, floor, location, scan_time, floors, points = json.loads(line)
+        return cls(user_id, floor, location, datetime.datetime.fromisoformat(scan_time), floors, points)
+
+
+class ScanWriteBuffer:
+    """ Write-behind buffer for scans: the scan row, impact totals and points of many scans go out in one transaction.
+
+    Crash safety: every scan is appended to a journal file before add() returns, and journals left by a
+    process that died are replayed on the next start. A scan is only written if no other scan of the same
+    user lies within the cooldown around it, so replaying a scan that was already committed is a no-op.
+
+    Read-your-writes: `pending(user_id)` returns what this process has buffered for a user but not
+    committed yet. Read it together with the database inside `consistent_read()`.
+    """
+
+    def __init__(self, cooldown_seconds, flush_ms=WRITE_BUFFER_FLUSH_MS,
+                 max_records=WRITE_BUFFER_MAX_RECORDS, journal_dir=WRITE_BUFFER_JOURNAL_DIR):
+        self.cooldown = int(cooldown_seconds)
+        self.flush_interval = flush_ms / 1000
+        self.max_records = max(1, max_records)
+        self.journal_prefix = os.path.join(journal_dir, os.path.basename(storage.DB_PATH) + "-scans")
+
+        self._lock = threading.Lock()  # guards the fields below
+        self._records = []
+        self._pending = {}  # user_id -> [points, floors] buffered but not committed
+        self._journal = None
+        self._journal_path = None
+        self._sealed = []  # rotated journal files whose scans are not committed yet
+        self._sequence = 0
+        self._pid = None
+        self._owner = None  # "<pid>-<process start time>", unique even when a pid is reused
+
+        self._flush_lock = threading.RLock()  # held while a batch is committed
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def synchronous(self):
+        return self.flush_interval <= 0
+
+    def _start(self):
+        """ Opens this process's journal and starts the flusher, lazily so it happens inside each gunicorn worker. """
+        self._pid = os.getpid()
+        self._owner = f"{self._pid}-{_process_token(self._pid) or uuid.uuid4().hex}"
+        self._records, self._pending, self._sealed = [], {}, []
+        if not self.synchronous:  # in synchronous mode scans are committed before add() returns, no journal needed
+            self._open_journal()
+            self._thread = threading.Thread(target=self._run, name="scan-flusher", daemon=True)
+            self._thread.start()
+
+    def _open_journal(self):
+        self._journal_path = f"{self.journal_prefix}-{self._owner}.journal"
+        self._journal = open(self._journal_path, "a", encoding="utf-8")
+
+    def _rotate_journal(self):
+        """ Seals the current journal (it holds exactly the scans being flushed) and starts a new one. Call with the lock held. """
+        self._journal.close()
+        self._sequence += 1
+        sealed = f"{self.journal_prefix}-{self._owner}.{self._sequence}.journal"
+        os.replace(self._journal_path, sealed)
+        self._sealed.append(sealed)
+        self._open_journal()
+
+    def add(self, user_id, floor, location, scan_time, floors, points):
+        """ Buffers a scan and the points it earns. Returns False if the cooldown guard rejected it (synchronous mode only). """
+        record = ScanRecord(user_id, floor, location, scan_time, floors, points)
+        with self._lock:
+            started = self._pid != os.getpid()
+            if started:
+                self._start()
+            if self._journal is not None:
+                self._journal.write(record.to_json() + "\n")
+                self._journal.flush()  # in the OS page cache: survives the process crashing
+            self._records.append(record)
+            pending = self._pending.setdefault(user_id, [0, 0])
+            pending[0] += points
+            pending[1] += floors
+            full = len(self._records) >= self.max_records
+
+        if started:
+            self.recover()  # e.g. journals of a crashed worker whose pid this process now has
+        if self.synchronous:
+            self.flush()
+            return record.written
+        if full:
+            self._wakeup.set()
+        return True
+
+    def pending(self, user_id):
+        """ (points, floors) this process has buffered for the user but not committed yet. """
+        with self._lock:
+            points, floors = self._pending.get(user_id, (0, 0))
+        return points, floors
+
+    def pending_floors(self):
+        """ Floors climbed by all buffered scans. """
+        with self._lock:
+            return sum(floors for _, floors in self._pending.values())
+
+    def __len__(self):
+        return len(self._records)
+
+    @contextmanager
+    def consistent_read(self):
+        """ Keeps a flush from landing between a database read and a `pending()` call. """
+        with self._flush_lock:
+            yield
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """ Commits everything buffered so far in one transaction. Returns the number of scans written. """
+        with self._flush_lock:
+            with self._lock:
+                if not self._records:
+                    return 0
+                batch, self._records = self._records, []
+                if self._journal is not None:
+                    self._rotate_journal()
+                sealed = list(self._sealed)
+
+            try:
+                with metrics.timed(FLUSH_LATENCY):
+                    written, updates = self._commit(batch)
+            except Exception:
+                logger.exception(f"🚨 Could not write {len(batch)} buffered scans, retrying on the next flush")
+                with self._lock:
+                    self._records = batch + self._records
+                return 0
+
+            with self._lock:
+                for record in batch:
+                    pending = self._pending[record.user_id]
+                    pending[0] -= record.points
+                    pending[1] -= record.floors
+                    if pending == [0, 0]:
+                        del self._pending[record.user_id]
+                self._sealed = [path for path in self._sealed if path not in sealed]
+            for path in sealed:
+                os.remove(path)
+
+        # Keep the in-memory leaderboard in sync, in the order the points versions were committed
+        for user_id, points, version in updates:
+            rank_index.apply(user_id, points, version)
+        FLUSHED_SCANS.labels(result="written").inc(written)
+        FLUSHED_SCANS.labels(result="dropped").inc(len(batch) - written)
+        return written
+
+    def _commit(self, batch):
+        """ Writes a batch in one transaction. Returns (scans written, [(user_id, points, version)]). """
+        written, total_floors, points, scans = 0, 0, {}, []
+        with storage.transaction() as conn:
+            for record in batch:
+                floor_from, floor_to = parse_floor(record.floor)
+                scanned_at = int(record.scan_time.timestamp())
+                # The cooldown guard: another worker (or an earlier run of this journal) may already have this scan
+                inserted = conn.execute("""
+                    INSERT INTO scans (user_id, site_id, floor_from, floor_to, scanned_at)
+                    SELECT ?, ?, ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM scans WHERE user_id = ? AND scanned_at > ? AND scanned_at < ?)
+                """, (record.user_id, storage.site_id(conn, record.location), floor_from, floor_to, scanned_at,
+                      record.user_id, scanned_at - self.cooldown, scanned_at + self.cooldown)).rowcount
+                if not inserted:
+                    continue
+
+                record.written = True
+                written += 1
+                total_floors += record.floors
+                points[record.user_id] = points.get(record.user_id, 0) + record.points
+                scans.append((record.user_id, record.location, record.scan_time, 1, record.floors, record.points))
+                # Impact totals are updated together with the scan, so they can never drift apart
+                conn.execute("""
+                    INSERT INTO user_impact (user_id, floors_climbed) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET floors_climbed = floors_climbed + excluded.floors_climbed
+                """, (record.user_id, record.floors))
+
+            if total_floors:
+                storage.bump_counter(conn, TOTAL_FLOORS_KEY, total_floors)
+            record_scans(conn, scans)  # day / month / building rollups
+
+            updates = []
+            for user_id, delta in points.items():
+                row = conn.execute("SELECT points FROM all_user_points WHERE user_id = ?", (user_id,)).fetchone()
+                new_points = (row[0] if row else 0) + delta
+                level, points_needed = calculate_level(new_points)
+                conn.execute("""
+                    INSERT INTO all_user_points (user_id, points, level, points_to_next_level)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                    points = excluded.points, level = excluded.level, points_to_next_level = excluded.points_to_next_level
+                """, (user_id, new_points, level, points_needed))
+                updates.append((user_id, new_points, record_points(conn, user_id, new_points)))
+        return written, updates
+
+    def recover(self):
+        """ Replays journals left behind by processes that are no longer running. Returns the number of scans written. """
+        written = 0
+        me = self._owner or f"{os.getpid()}-{_process_token(os.getpid())}"
+        for path in sorted(glob.glob(f"{self.journal_prefix}-*.journal*")):
+            # scans.db-scans-<owner>[.<n>].journal, or ...journal.replaying-<owner> if a replay was interrupted
+            name = os.path.basename(path)
+            if ".replaying-" in name:
+                owner = name.split(".replaying-")[1]
+            else:
+                owner = name[len(os.path.basename(self.journal_prefix)) + 1:].split(".")[0]
+            if owner == me or _owner_alive(owner):
+                continue
+
+            claimed = f"{path.split('.replaying-')[0]}.replaying-{me}"
+            try:
+                os.replace(path, claimed)  # only one starting worker gets to replay each journal
+            except FileNotFoundError:
+                continue
+
+            batch = []
+            with open(claimed, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        batch.append(ScanRecord.from_json(line))
+                    except ValueError:
+                        logger.warning(f"🚨 Skipping unreadable line in {path} (probably cut off by the crash)")
+            if batch:
+                scans, updates = self._commit(batch)
+                for user_id, points, version in updates:
+                    rank_index.apply(user_id, points, version)
+                written += scans
+                logger.info(f"✅ Replayed {scans} of {len(batch)} scans from {path}")
+            os.remove(claimed)
+        return written
+
+    def close(self):
+        """ Stops the flusher and writes whatever is still buffered. """
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(5)
+        self.flush()
+        with self._lock:
+            if self._journal is not None and self._pid == os.getpid() and not self._records:
+                self._journal.close()
+                os.remove(self._journal_path)
+                self._journal = None
+
+
+def _process_token(pid):
+    """ Start time of a process (Linux), which tells it apart from an earlier process with the same pid. """
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _owner_alive(owner):
+    """ Whether the process that wrote a journal ("<pid>-<token>", or just "<pid>" for older journals) still runs. """
+    pid, _, token = owner.partition("-")
+    if not pid.isdigit():
+        return True  # not ours, leave it alone
+    if int(pid) == os.getpid():
+        return False  # an earlier process that had our pid
+    if not _process_alive(int(pid)):
+        return False
+    current = _process_token(int(pid))
+    return current is None or not token or current == token  # tokens only differ if the pid was reused
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,68 @@
+import json
+import os
+from math import radians, cos, sin, sqrt, atan2
+
+SITES_PATH = os.getenv("SITES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sites.json"))
+
+
+def floor_label(start):
+    """ Label of the staircase from floor `start` to the next one, e.g. 1 -> "1-2F". """
+    return f"{start}-{start + 1}F"
+
+
+def parse_floor(floor_name):
+    """ Splits a floor label like "1-2F" into (1, 2). """
+    start, end = floor_name.rstrip("F").split("-")
+    return int(start), int(end)
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """ Calculates distance between two GPS coordinates in meters. """
+    R = 6371000  # Radius of Earth in meters
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat/2) * sin(dlat/2) + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2) * sin(dlon/2)
+    c = 2 * atan2(sqrt(a), sqrt(1-a))
+    return R * c
+
+
+class Site:
+    """ A building with QR codes on its staircases. """
+
+    def __init__(self, name, lat, lng, floors, first_floor=1):
+        self.name = name
+        self.coordinates = (lat, lng)
+        self.floor_labels = [floor_label(i) for i in range(first_floor, first_floor + floors)]
+        self.floors = frozenset(self.floor_labels)  # set lookup for scan validation
+
+    def __repr__(self):
+        return f"Site({self.name!r}, floors={len(self.floor_labels)})"
+
+
+class SiteRegistry:
+    """ All QR sites, looked up by name (the name is part of every QR payload). """
+
+    def __init__(self, sites):
+        self.sites = {site.name: site for site in sites}
+
+    def __iter__(self):
+        return iter(self.sites.values())
+
+    def __len__(self):
+        return len(self.sites)
+
+    def get(self, name):
+        return self.sites.get(name)
+
+
+def load_sites(path=SITES_PATH):
+    """ Loads the site registry from a JSON config file. """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    return SiteRegistry([
+        Site(entry["name"], entry["lat"], entry["lng"], entry["floors"], entry.get("first_floor", 1))
+        for entry in config["sites"]
+    ])
+
+
+site_registry = load_sites()
@@ -0,0 +1,522 @@
+import datetime
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from metrics import SQL_LATENCY, SQL_ROWS
+
+DB_PATH = os.getenv("DB_PATH", "scans.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+
+PRAGMAS = (
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",  # wait for other gunicorn workers instead of failing
+    "PRAGMA journal_mode = WAL",  # readers never block the writer, and several processes can share the file
+    "PRAGMA synchronous = NORMAL",  # safe with WAL, one fsync per checkpoint instead of per commit
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+# The first table a statement reads or writes
+STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+[\"`]?(\w+)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=512)
+def statement_label(sql):
+    """ Kind and main table of a SQL statement (e.g. "SELECT scans"), used as its metrics label.
+
+    Keeps the number of label values small: one per kind of statement and table, not one per query text.
+    """
+    words = sql.split(None, 1)
+    if not words:
+        return ""
+    kind = words[0].upper()
+    if kind == "WITH":
+        kind = "SELECT"  # common table expressions in this code are all reads
+    if kind not in ("SELECT", "INSERT", "REPLACE", "UPDATE", "DELETE"):
+        return kind  # PRAGMA, BEGIN, and schema changes that only run at startup
+    match = STATEMENT_TABLE.search(sql)
+    return f"{kind} {match.group(1)}" if match else kind
+
+
+class MeteredCursor(sqlite3.Cursor):
+    """ Counts the rows fetched through it into the statement's row counter. """
+
+    rows = None
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self.rows is not None:
+            self.rows.inc()
+        return row
+
+    def fetchmany(self, size=1):
+        rows = super().fetchmany(size)
+        if self.rows is not None:
+            self.rows.inc(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self.rows is not None:
+            self.rows.inc(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        if self.rows is not None:
+            self.rows.inc()
+        return row
+
+
+class MeteredConnection(sqlite3.Connection):
+    """ Records the latency and row count of every statement. """
+
+    after_commit = None  # see transaction()
+
+    def execute(self, sql, parameters=()):
+        label = statement_label(sql)
+        cursor = self.cursor(MeteredCursor)
+        started = time.perf_counter()
+        cursor.execute(sql, parameters)
+        SQL_LATENCY.labels(statement=label).observe(time.perf_counter() - started)
+        cursor.rows = SQL_ROWS.labels(statement=label)
+        if cursor.rowcount > 0:
+            cursor.rows.inc(cursor.rowcount)  # rows changed by a write
+        return cursor
+
+    def executemany(self, sql, seq_of_parameters):
+        label = statement_label(sql)
+        started = time.perf_counter()
+        cursor = super().executemany(sql, seq_of_parameters)
+        SQL_LATENCY.labels(statement=label).observe(time.perf_counter() - started)
+        if cursor.rowcount > 0:
+            SQL_ROWS.labels(statement=label).inc(cursor.rowcount)
+        return cursor
+
+
+class ConnectionPool:
+    """ Hands out one SQLite connection per caller, so threads never share a cursor. """
+
+    def __init__(self, path=DB_PATH, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections must never cross a fork, so each gunicorn worker gets its own pool
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=self.size)
+
+    def _connect(self):
+        # isolation_level=None: autocommit by default, transactions are opened explicitly
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               isolation_level=None, check_same_thread=False, factory=MeteredConnection)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """ Borrows a connection for the duration of the `with` block. """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle = self._idle
+
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+
+pool = ConnectionPool()
+
+
+@contextmanager
+def transaction():
+    """ Short write transaction: takes the write lock up front (BEGIN IMMEDIATE) and commits on exit.
+
+    Callables appended to `conn.after_commit` run once the commit succeeded, and are dropped on a rollback.
+    """
+    with pool.connection() as conn:
+        conn.after_commit = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            callbacks, conn.after_commit = conn.after_commit, []
+        for callback in callbacks:
+            callback()
+
+
+def query_one(sql, params=()):
+    """ Runs a read query and returns the first row (or None). """
+    with pool.connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+
+def query_all(sql, params=()):
+    """ Runs a read query and returns every row. """
+    with pool.connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def execute(sql, params=()):
+    """ Runs a single write statement in its own transaction. Returns the number of changed rows. """
+    with transaction() as conn:
+        return conn.execute(sql, params).rowcount
+
+
+def read_counter(key):
+    """ Returns a counter from the meta table (0 if it was never bumped). """
+    row = query_one("SELECT value FROM meta WHERE key = ?", (key,))
+    return row[0] if row else 0
+
+
+def bump_counter(conn, key, amount=1):
+    """ Adds `amount` to a counter inside the caller's transaction and returns the new value. """
+    conn.execute("""
+        INSERT INTO meta (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+    """, (key, amount))
+    return conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+
+SCHEMA_VERSION = 2
+SCHEMA_VERSION_KEY = "schema_version"
+LEGACY_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"  # scan_logs.timestamp before schema version 2
+LEGACY_BATCH_ROWS = int(os.getenv("LEGACY_BATCH_ROWS", "5000"))
+
+_STRICT = " STRICT" if sqlite3.sqlite_version_info >= (3, 37) else ""
+
+# Legacy floor labels like "1-2F" as (from, to) integers, for the view over not yet migrated rows
+_LEGACY_FLOOR_FROM = "CAST(substr(floor, 1, instr(floor, '-') - 1) AS INTEGER)"
+_LEGACY_FLOOR_TO = "CAST(rtrim(substr(floor, instr(floor, '-') + 1), 'F') AS INTEGER)"
+
+_site_ids = {}  # site name -> sites.id (ids never change once committed)
+
+
+def site_id(conn, name):
+    """ Returns the id of a site in the sites table, adding it inside the caller's transaction if it is new. """
+    cached = _site_ids.get(name)
+    if cached is not None:
+        return cached
+    row = conn.execute("SELECT id FROM sites WHERE name = ?", (name,)).fetchone()
+    row_id = row[0] if row else conn.execute("INSERT INTO sites (name) VALUES (?)", (name,)).lastrowid
+    if not conn.in_transaction:
+        _site_ids[name] = row_id
+    elif getattr(conn, "after_commit", None) is not None:
+        # The row may come from the caller's transaction, which could still roll back
+        conn.after_commit.append(lambda: _site_ids.setdefault(name, row_id))
+    return row_id
+
+
+def parse_legacy_scan(conn, user_id, floor, location, timestamp):
+    """ Converts a schema version 1 scan_logs row to (user_id, site_id, floor_from, floor_to, scanned_at). """
+    try:
+        floor_from, floor_to = (int(part) for part in floor.rstrip("F").split("-"))
+    except (AttributeError, ValueError):
+        floor_from = floor_to = 0  # unreadable floors count as a scan without floors, as before
+    try:
+        scanned_at = int(datetime.datetime.strptime(timestamp, LEGACY_TIME_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        scanned_at = 0
+    return user_id or "", site_id(conn, location or ""), floor_from, floor_to, scanned_at
+
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def _create_scan_history_view(conn):
+    """ scan_history: every scan ever made as (user_id, site_id, day, floor_from, floor_to, scans).
+
+    It covers the raw scans, the daily summaries compaction folded older scans into, and, while
+    the online migration is still running, the schema version 1 rows it has not moved yet.
+    """
+    legacy = ""
+    if _table_exists(conn, "scan_logs_v1"):
+        legacy = f"""
+            UNION ALL
+            SELECT user_id, (SELECT id FROM sites WHERE name = COALESCE(location, '')), replace(substr(timestamp, 1, 10), '/', '-'),
+                   {_LEGACY_FLOOR_FROM}, {_LEGACY_FLOOR_TO}, 1
+            FROM scan_logs_v1
+        """
+    conn.execute("DROP VIEW IF EXISTS scan_history")
+    conn.execute(f"""
+        CREATE VIEW scan_history (user_id, site_id, day, floor_from, floor_to, scans) AS
+        SELECT user_id, site_id, date(scanned_at, 'unixepoch', 'localtime'), floor_from, floor_to, 1 FROM scans
+        UNION ALL
+        SELECT user_id, site_id, day, floor_from, floor_to, scans FROM scan_daily_summary
+        {legacy}
+    """)
+
+
+def _migrate_to_2(conn):
+    """ Schema version 2: typed, compact scans (integer times and floors, sites table) and a STRICT all_user_points.
+
+    The small tables are converted right away. scan_logs is renamed to scan_logs_v1 and moved over
+    in the background by migrate_legacy_scans(), so a large history does not hold up startup.
+    """
+    for table in ("scan_logs", "all_user_points", "scan_daily_summary"):
+        if _table_exists(conn, table):
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_v1")
+    _create_scan_tables(conn)
+    if _table_exists(conn, "scan_logs_v1"):
+        # Site ids for every building in the history, so scan_history can show unmoved rows too
+        conn.execute("INSERT OR IGNORE INTO sites (name) SELECT DISTINCT COALESCE(location, '') FROM scan_logs_v1")
+
+    if _table_exists(conn, "all_user_points_v1"):
+        conn.execute("""
+            INSERT INTO all_user_points (user_id, points, level, points_to_next_level)
+            SELECT user_id, COALESCE(points, 0), COALESCE(level, 1), COALESCE(points_to_next_level, 0)
+            FROM all_user_points_v1 WHERE user_id IS NOT NULL
+        """)
+        conn.execute("DROP TABLE all_user_points_v1")
+
+    if _table_exists(conn, "scan_daily_summary_v1"):
+        summaries = {}
+        for day, user_id, location, floor, scans in conn.execute(
+                "SELECT day, user_id, location, floor, scans FROM scan_daily_summary_v1").fetchall():
+            user_id, site, floor_from, floor_to, _ = parse_legacy_scan(conn, user_id, floor, location, None)
+            key = (day, user_id, site, floor_from, floor_to)
+            summaries[key] = summaries.get(key, 0) + scans
+        conn.executemany("""
+            INSERT INTO scan_daily_summary (day, user_id, site_id, floor_from, floor_to, scans) VALUES (?, ?, ?, ?, ?, ?)
+        """, [(*key, scans) for key, scans in summaries.items()])
+        conn.execute("DROP TABLE scan_daily_summary_v1")
+
+
+MIGRATIONS = {2: _migrate_to_2}
+
+
+def _create_scan_tables(conn):
+    """ Scan and points tables in their current (version 2) form. """
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS sites (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        ){_STRICT}
+    """)
+
+    # One row per QR scan: integer epoch seconds and floors, and a small site id instead of the building name
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS scans (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            site_id INTEGER NOT NULL REFERENCES sites (id),
+            floor_from INTEGER NOT NULL,
+            floor_to INTEGER NOT NULL,
+            scanned_at INTEGER NOT NULL
+        ){_STRICT}
+    """)
+
+    # Cooldown checks look up a user's latest scan, this keeps them from sorting the whole history
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scans_user_time ON scans (user_id, scanned_at)")
+
+    # Scans older than the compaction horizon, folded into one row per user, staircase and day (see compaction.py)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS scan_daily_summary (
+            day TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            site_id INTEGER NOT NULL REFERENCES sites (id),
+            floor_from INTEGER NOT NULL,
+            floor_to INTEGER NOT NULL,
+            scans INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id, site_id, floor_from, floor_to)
+        ){_STRICT}{"," if _STRICT else ""} WITHOUT ROWID
+    """)
+
+    # Points and level per user (WITHOUT ROWID: looked up by user_id only, so no separate rowid b-tree)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS all_user_points (
+            user_id TEXT PRIMARY KEY,
+            points INTEGER NOT NULL DEFAULT 0,
+            level INTEGER NOT NULL DEFAULT 1,
+            points_to_next_level INTEGER NOT NULL DEFAULT 0
+        ){_STRICT}{"," if _STRICT else ""} WITHOUT ROWID
+    """)
+
+
+def migrate_legacy_scans(batch_rows=LEGACY_BATCH_ROWS):
+    """ Moves schema version 1 scan_logs rows into scans, one short transaction per batch. Returns the rows moved.
+
+    Safe to run from several workers at once: each batch moves and deletes its rows in one transaction.
+    """
+    moved = 0
+    while True:
+        with transaction() as conn:
+            if not _table_exists(conn, "scan_logs_v1"):
+                return moved
+            rows = conn.execute("""
+                SELECT id, user_id, floor, location, timestamp FROM scan_logs_v1 ORDER BY id LIMIT ?
+            """, (batch_rows,)).fetchall()
+            if not rows:
+                # Everything is moved: drop the old table and stop reading it in scan_history
+                conn.execute("DROP VIEW IF EXISTS scan_history")
+                conn.execute("DROP TABLE scan_logs_v1")
+                _create_scan_history_view(conn)
+                return moved
+
+            conn.executemany("""
+                INSERT INTO scans (user_id, site_id, floor_from, floor_to, scanned_at) VALUES (?, ?, ?, ?, ?)
+            """, [parse_legacy_scan(conn, *row[1:]) for row in rows])
+            conn.execute("DELETE FROM scan_logs_v1 WHERE id <= ?", (rows[-1][0],))
+            moved += len(rows)
+
+
+def legacy_scans_pending():
+    """ True while migrate_legacy_scans() still has rows to move. """
+    with pool.connection() as conn:
+        return _table_exists(conn, "scan_logs_v1")
+
+
+def init_db():
+    """ Creates the tables if they do not exist yet, and brings older databases up to SCHEMA_VERSION. """
+    with transaction() as conn:
+        # Small counters shared by all workers (e.g. version numbers used to keep in-memory caches coherent)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (SCHEMA_VERSION_KEY,)).fetchone()
+        version = row[0] if row else (1 if _table_exists(conn, "scan_logs") else SCHEMA_VERSION)
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            MIGRATIONS[target](conn)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (SCHEMA_VERSION_KEY, SCHEMA_VERSION))
+
+        _create_scan_tables(conn)
+        _create_scan_history_view(conn)
+
+        # Create user_settings table to store user related info (gps location permission)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_settings (
+                user_id TEXT PRIMARY KEY,
+                location_consent INTEGER DEFAULT 0,
+                language TEXT DEFAULT 'English'
+            )
+        """)
+
+        # Floors climbed per user, kept up to date with every scan (the total for all users is in meta)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_impact (
+                user_id TEXT PRIMARY KEY,
+                floors_climbed INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        # Per-period rollups of scans, updated with every scan, so period leaderboards never read the scans table
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_daily_stats (
+                day TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                scans INTEGER NOT NULL DEFAULT 0,
+                floors INTEGER NOT NULL DEFAULT 0,
+                points INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, user_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_monthly_stats (
+                month TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                scans INTEGER NOT NULL DEFAULT 0,
+                floors INTEGER NOT NULL DEFAULT 0,
+                points INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (month, user_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_monthly_stats_points ON user_monthly_stats (month, points)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS building_monthly_stats (
+                month TEXT NOT NULL,
+                location TEXT NOT NULL,
+                scans INTEGER NOT NULL DEFAULT 0,
+                floors INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (month, location)
+            ) WITHOUT ROWID
+        """)
+
+        # The latest points changes by points_version, so other workers can catch up their leaderboards (see leaderboard.py)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS points_changes (
+                version INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                points INTEGER NOT NULL
+            )
+        """)
+
+        # Webhook event ids that were already handled, so LINE redeliveries are dropped
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_events (
+                event_id TEXT PRIMARY KEY,
+                seen_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_events_seen_at ON processed_events (seen_at)")
+
+        # Create table for feedback
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS feedback (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                report TEXT,
+                timestamp TEXT
+            )
+        """)
+
+        # LINE display names, refreshed in the background (see profiles.py)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_profiles (
+                user_id TEXT PRIMARY KEY,
+                display_name TEXT NOT NULL,
+                picture_url TEXT,
+                fetched_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+        # Broadcasts (see broadcast.py): the rendered messages, and who has been sent them, so a rerun resumes
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id TEXT PRIMARY KEY,
+                messages TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                finished_at INTEGER
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                language TEXT NOT NULL,
+                chunk INTEGER NOT NULL,
+                sent_at INTEGER,
+                PRIMARY KEY (broadcast_id, user_id)
+            ) WITHOUT ROWID
+        """)
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# The modules read their configuration at import time, so point them at a scratch database first
+_workdir = tempfile.mkdtemp(prefix="staircase-tests-")
+os.environ.setdefault("DB_PATH", os.path.join(_workdir, "scans.db"))
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("LINE_ACCESS_TOKEN", "test-token")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,21 @@
+import storage
+from broadcast import winners_messages
+
+
+class FakeProfiles:
+    def __init__(self, names):
+        self._names = names
+
+    def names(self, user_ids):
+        return {user_id: self._names.get(user_id) for user_id in user_ids}
+
+
+def test_winners_are_announced_by_name():
+    storage.init_db()
+    storage.execute("""
+        INSERT INTO user_monthly_stats (month, user_id, scans, floors, points)
+        VALUES ('2024-02', 'Uwinner', 10, 10, 30), ('2024-02', 'Unameless', 5, 5, 20)
+    """)
+    english = winners_messages("2024-02", 2, FakeProfiles({"Uwinner": "Amy"}))["English"][0]
+    assert "🥇 Rank 1 - Amy, 30 points" in english
+    assert "🥈 Rank 2 - 20 points" in english
@@ -0,0 +1,53 @@
+import datetime
+
+import compaction
+import storage
+
+OLD = datetime.datetime(2023, 5, 1, 8)
+NOW = datetime.datetime(2023, 9, 1)
+
+
+def add_old_scans(user_id, count):
+    with storage.transaction() as conn:
+        site = storage.site_id(conn, "機械系館1")
+        conn.executemany("INSERT INTO scans (user_id, site_id, floor_from, floor_to, scanned_at) VALUES (?, ?, 1, 2, ?)",
+                         [(user_id, site, int(OLD.timestamp()) + i * 60) for i in range(count)])
+
+
+def summarized(user_id):
+    return storage.query_one("SELECT COALESCE(SUM(scans), 0) FROM scan_daily_summary WHERE user_id = ?", (user_id,))[0]
+
+
+def raw(user_id):
+    return storage.query_one("SELECT COUNT(*) FROM scans WHERE user_id = ?", (user_id,))[0]
+
+
+def test_old_scans_are_archived_and_folded(tmp_path):
+    storage.init_db()
+    add_old_scans("Ucompact", 5)
+    compaction.compact(90, str(tmp_path), now=NOW)
+    assert raw("Ucompact") == 0
+    assert summarized("Ucompact") == 5
+    archived = list(compaction.read_archive(str(tmp_path / "scans-2023-05.jsonl.gz")))
+    assert sum(1 for scan in archived if scan["user_id"] == "Ucompact") == 5
+
+
+def test_rows_removed_while_archiving_are_not_folded_twice(tmp_path, monkeypatch):
+    storage.init_db()
+    add_old_scans("Uconcurrent", 4)
+    append_archive = compaction._append_archive
+
+    def archive_while_another_run_compacts(archive_dir, rows):
+        append_archive(archive_dir, rows)
+        # Another run folds one of the rows before this one takes the write lock
+        first = [row for row in rows if row[1] == "Uconcurrent"][0]
+        storage.execute("DELETE FROM scans WHERE id = ?", (first[0],))
+        storage.execute("""
+            INSERT INTO scan_daily_summary (day, user_id, site_id, floor_from, floor_to, scans) VALUES (?, ?, ?, 1, 2, 1)
+            ON CONFLICT(day, user_id, site_id, floor_from, floor_to) DO UPDATE SET scans = scans + 1
+        """, (OLD.strftime("%Y-%m-%d"), "Uconcurrent", first[2]))
+    monkeypatch.setattr(compaction, "_append_archive", archive_while_another_run_compacts)
+
+    compaction.compact(90, str(tmp_path), now=NOW)
+    assert raw("Uconcurrent") == 0
+    assert summarized("Uconcurrent") == 4
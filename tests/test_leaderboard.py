@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+import leaderboard
+import storage
+from leaderboard import FenwickTree, RankIndex, record_points
+
+
+def test_fenwick_tree_matches_a_sorted_list():
+    rng = random.Random(1)
+    tree, scores = FenwickTree(size=4), []
+    for _ in range(500):
+        if scores and rng.random() < 0.3:
+            score = scores.pop(rng.randrange(len(scores)))
+            tree.add(score, -1)
+        else:
+            score = rng.randrange(3000)  # beyond the initial size, so the tree grows
+            scores.append(score)
+            tree.add(score, 1)
+        ordered = sorted(scores)
+        probe = rng.randrange(3100)
+        assert tree.prefix(probe) == sum(1 for s in scores if s <= probe)
+        if ordered:
+            k = rng.randrange(1, len(ordered) + 1)
+            assert tree.kth(k) == ordered[k - 1]
+
+
+def expected_standing(points_by_user, user_id):
+    points = points_by_user[user_id]
+    distinct = sorted(set(points_by_user.values()))
+
+    def rank(p):
+        return 1 + sum(1 for other in points_by_user.values() if other > p)
+    higher = [p for p in distinct if p > points]
+    lower = [p for p in distinct if p < points]
+    return (points, rank(points),
+            (higher[0], rank(higher[0])) if higher else None,
+            (lower[-1], rank(lower[-1])) if lower else None)
+
+
+def write_points(user_id, points):
+    with storage.transaction() as conn:
+        conn.execute("""
+            INSERT INTO all_user_points (user_id, points) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET points = excluded.points
+        """, (user_id, points))
+        return record_points(conn, user_id, points)
+
+
+def stored_points():
+    return dict(storage.query_all("SELECT user_id, points FROM all_user_points"))
+
+
+def test_changes_from_other_workers_are_replayed_without_a_reload(monkeypatch):
+    storage.init_db()
+    rng = random.Random(2)
+    for i in range(30):
+        write_points(f"Urank{i}", rng.randrange(50))
+
+    index = RankIndex()
+    index.top(1)  # first load
+
+    def reload(version):
+        raise AssertionError("should have replayed the log")
+    monkeypatch.setattr(index, "_rebuild", reload)
+    for _ in range(100):
+        write_points(f"Urank{rng.randrange(40)}", rng.randrange(50))  # another worker: no apply() here
+        points = stored_points()
+        user_id = rng.choice(sorted(points))
+        assert index.standing(user_id) == expected_standing(points, user_id)
+
+    ordered = sorted(points.items(), key=lambda item: (-item[1], item[0]))
+    assert [(user_id, p) for user_id, p, _ in index.top(10)] == ordered[:10]
+
+
+def test_reloads_when_the_log_was_pruned(monkeypatch):
+    storage.init_db()
+    index = RankIndex()
+    index.top(1)
+    monkeypatch.setattr(leaderboard, "POINTS_CHANGELOG_SIZE", 2)
+    for i in range(5):
+        write_points("Upruned", 100 + i)
+
+    reloads = []
+    rebuild = index._rebuild
+    monkeypatch.setattr(index, "_rebuild", lambda version: reloads.append(version) or rebuild(version))
+    assert index.standing("Upruned")[0] == 104
+    assert len(reloads) == 1
+
+
+@pytest.mark.parametrize("version_offset", [2, 0])
+def test_apply_only_takes_the_next_version(version_offset):
+    storage.init_db()
+    index = RankIndex()
+    index.top(1)
+    current = index._version
+    index.apply("Uapplied", 7, current + version_offset)
+    assert "Uapplied" not in index._points
+    assert index._version == current
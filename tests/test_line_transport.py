@@ -0,0 +1,57 @@
+import socket
+import threading
+
+import pytest
+import requests
+
+import line_stub
+from line_transport import PooledHttpClient
+
+
+@pytest.fixture
+def stub():
+    server = line_stub.make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def client():
+    transport = PooledHttpClient(timeout=(1, 0.1), max_retries=3)
+    transport._backoff = lambda attempt: 0
+    return transport
+
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_reply_is_not_resent_after_a_read_timeout(stub):
+    stub.latency = 0.3
+    with pytest.raises(requests.Timeout):
+        client().post(url(stub, "/v2/bot/message/reply"), data="{}")
+    assert stub.calls["POST /v2/bot/message/reply"] == 1
+
+
+def test_reply_is_not_resent_after_a_server_error(stub):
+    stub.fail_rate = 1.0
+    assert client().post(url(stub, "/v2/bot/message/reply"), data="{}").status_code == 500
+    assert stub.calls["POST /v2/bot/message/reply"] == 1
+
+
+def test_push_is_retried(stub):
+    stub.fail_rate = 1.0
+    assert client().post(url(stub, "/v2/bot/message/push"), data="{}").status_code == 500
+    assert stub.calls["POST /v2/bot/message/push"] == 4
+
+
+def test_reply_is_retried_when_it_never_connected():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]  # nothing listens here once the socket is closed
+    transport = client()
+    attempts = []
+    transport.bucket.acquire = lambda: attempts.append(1)
+    with pytest.raises(requests.ConnectionError):
+        transport.post(f"http://127.0.0.1:{port}/v2/bot/message/reply", data="{}")
+    assert len(attempts) == 4
@@ -0,0 +1,27 @@
+from metrics import Counter
+from storage import statement_label
+
+
+def test_counter_type_line_matches_its_samples():
+    counter = Counter("test_events", "Events", ["kind"])
+    counter.labels(kind="a").inc()
+    lines = counter.render()
+    assert lines[:2] == ["# HELP test_events_total Events", "# TYPE test_events_total counter"]
+    assert lines[2] == 'test_events_total{kind="a"} 1.0'
+
+
+def test_statement_label_is_kind_and_table():
+    assert statement_label("""
+        SELECT MAX(scanned_at) FROM scans WHERE user_id = ?
+    """) == "SELECT scans"
+    assert statement_label("INSERT INTO all_user_points (user_id) VALUES (?) ON CONFLICT(user_id) DO NOTHING") \
+        == "INSERT all_user_points"
+    assert statement_label("UPDATE user_settings SET language = ? WHERE user_id = ?") == "UPDATE user_settings"
+    assert statement_label("DELETE FROM processed_events WHERE event_id = ?") == "DELETE processed_events"
+    assert statement_label("PRAGMA journal_mode = WAL") == "PRAGMA"
+    assert statement_label("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)") == "CREATE"
+
+
+def test_collected_counter_renders_a_total_sample():
+    counter = Counter("test_collected", "Collected", collect=lambda: 3)
+    assert counter.render()[-1] == "test_collected_total 3"
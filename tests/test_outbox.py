@@ -0,0 +1,54 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+from linebot.models.error import Error
+
+from outbox import Outbox
+
+
+class FakeApi:
+    def __init__(self, reply_error=None):
+        self.reply_error = reply_error
+        self.replies, self.pushes = [], []
+
+    def reply_message(self, token, messages):
+        if self.reply_error:
+            raise self.reply_error
+        self.replies.append(messages)
+
+    def push_message(self, user_id, messages):
+        self.pushes.append(messages)
+
+
+def event():
+    return SimpleNamespace(source=SimpleNamespace(user_id="U1"), reply_token="token",
+                           timestamp=int(time.time() * 1000), webhook_event_id="e1")
+
+
+def send_one(api):
+    outbox = Outbox(api)
+    with outbox.collect(event()):
+        outbox.send("U1", TextSendMessage(text="hi"))
+
+
+def test_rejected_reply_token_falls_back_to_push():
+    api = FakeApi(LineBotApiError(400, {}, error=Error(message="Invalid reply token")))
+    send_one(api)
+    assert len(api.pushes) == 1
+
+
+def test_other_reply_errors_are_raised_and_not_pushed():
+    api = FakeApi(LineBotApiError(400, {}, error=Error(message="The request body has 1 error(s)")))
+    with pytest.raises(LineBotApiError):
+        send_one(api)
+    assert api.pushes == []
+
+
+def test_transport_errors_are_raised():
+    api = FakeApi(ConnectionError("reset"))
+    with pytest.raises(ConnectionError):
+        send_one(api)
+    assert api.pushes == []
@@ -0,0 +1,34 @@
+import pytest
+
+from qr_signing import make_payload, parse_payload
+
+SECRET = "qr-test-secret"
+
+
+@pytest.mark.parametrize("location", ["機械系館1", "Hall_A", "North_Wing_2"])
+def test_signed_payload_round_trips(location):
+    payload = make_payload("1-2F", location, epoch=3, secret=SECRET)
+    assert parse_payload(payload, secret=SECRET, epoch=3, allow_unsigned=False) == ("1-2F", location)
+    assert parse_payload(payload, secret=SECRET, epoch=4, allow_unsigned=False) == ("1-2F", location)  # previous epoch
+    assert parse_payload(payload, secret=SECRET, epoch=5, allow_unsigned=False) is None
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda p: p.replace("1-2F", "3-4F"),
+    lambda p: p.replace("Hall_A", "Hall_B"),
+    lambda p: p[:-1] + ("a" if p[-1] != "a" else "b"),
+    lambda p: p.replace("_3_", "_2_"),
+])
+def test_tampered_payload_is_rejected(tamper):
+    payload = make_payload("1-2F", "Hall_A", epoch=3, secret=SECRET)
+    assert parse_payload(tamper(payload), secret=SECRET, epoch=3, allow_unsigned=False) is None
+    assert parse_payload(payload, secret="other-secret", epoch=3, allow_unsigned=False) is None
+
+
+def test_unsigned_payload_only_when_allowed():
+    payload = make_payload("1-2F", "Hall_A", secret="")
+    assert parse_payload(payload, secret="", allow_unsigned=False) == ("1-2F", "Hall_A")  # no secret configured
+    assert parse_payload(payload, secret=SECRET, allow_unsigned=True) == ("1-2F", "Hall_A")
+    assert parse_payload(payload, secret=SECRET, allow_unsigned=False) is None
+    assert parse_payload("STAIRCASE_QR_1-2F", secret="", allow_unsigned=True) is None
+    assert parse_payload("hello", secret=SECRET, allow_unsigned=True) is None
@@ -0,0 +1,38 @@
+import datetime
+import glob
+import os
+
+import storage
+from scan_buffer import ScanRecord, ScanWriteBuffer
+
+
+def scans_of(user_id):
+    return storage.query_one("SELECT COUNT(*) FROM scans WHERE user_id = ?", (user_id,))[0]
+
+
+def test_journal_of_a_dead_process_with_our_pid_is_replayed(tmp_path):
+    storage.init_db()
+    buffer = ScanWriteBuffer(15, flush_ms=50, journal_dir=str(tmp_path))
+    # Left behind by a crashed worker that had the pid this process has now
+    crashed = f"{buffer.journal_prefix}-{os.getpid()}-1.journal"
+    record = ScanRecord("Ucrashed", "1-2F", "機械系館1", datetime.datetime(2025, 1, 1, 8), 1, 1)
+    with open(crashed, "w", encoding="utf-8") as f:
+        f.write(record.to_json() + "\n")
+
+    buffer.add("Ulive", "1-2F", "機械系館1", datetime.datetime(2025, 1, 1, 9), 1, 1)
+    assert not os.path.exists(crashed)
+    assert crashed not in glob.glob(f"{buffer.journal_prefix}-*")
+    buffer.close()
+
+    assert scans_of("Ucrashed") == 1
+    assert scans_of("Ulive") == 1
+    assert glob.glob(str(tmp_path / "*.journal*")) == []
+
+
+def test_journal_of_a_live_process_is_left_alone(tmp_path):
+    storage.init_db()
+    buffer = ScanWriteBuffer(15, flush_ms=50, journal_dir=str(tmp_path))
+    buffer.add("Uself", "1-2F", "機械系館1", datetime.datetime(2025, 1, 2, 9), 1, 1)
+    assert buffer.recover() == 0  # its own, still open journal
+    buffer.close()
+    assert scans_of("Uself") == 1
@@ -0,0 +1,18 @@
+import pytest
+
+import storage
+
+
+def test_site_id_is_cached_only_after_commit():
+    storage.init_db()
+    with pytest.raises(RuntimeError):
+        with storage.transaction() as conn:
+            storage.site_id(conn, "rolled back")
+            storage.site_id(conn, "rolled back")  # read back from the uncommitted insert
+            raise RuntimeError
+    assert "rolled back" not in storage._site_ids
+
+    with storage.transaction() as conn:
+        committed = storage.site_id(conn, "committed")
+    assert storage._site_ids["committed"] == committed
+    assert storage.query_one("SELECT name FROM sites WHERE id = ?", (committed,)) == ("committed",)
@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+
+import app
+
+
+def post(client, events):
+    body = json.dumps({"destination": "x", "events": events})
+    signature = base64.b64encode(hmac.new(b"test-secret", body.encode(), hashlib.sha256).digest()).decode()
+    return client.post("/webhook", data=body, headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+
+
+def sticker_event(event_id, redelivery=False):
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000), "replyToken": "r",
+        "source": {"type": "user", "userId": "Utest"}, "webhookEventId": event_id,
+        "deliveryContext": {"isRedelivery": redelivery},
+        "message": {"type": "sticker", "id": "1", "packageId": "1", "stickerId": "1"},
+    }
+
+
+@pytest.fixture
+def client(monkeypatch):
+    handled = []
+    monkeypatch.setattr(app, "dispatch_event", handled.append)
+    return app.app.test_client(), handled
+
+
+def test_redelivery_after_full_queue_is_handled(client, monkeypatch):
+    client, handled = client
+    monkeypatch.setattr(app, "WEBHOOK_ASYNC", True)
+    monkeypatch.setattr(app.event_pool, "submit", lambda key, func, event: False)
+    assert post(client, [sticker_event("queue-full")]).status_code == 503
+
+    monkeypatch.setattr(app.event_pool, "submit", lambda key, func, event: func(event) or True)
+    assert post(client, [sticker_event("queue-full", redelivery=True)]).status_code == 200
+    assert [event.webhook_event_id for event in handled] == ["queue-full"]
+
+
+def test_redelivery_after_failed_dispatch_is_handled(client, monkeypatch):
+    client, handled = client
+    monkeypatch.setattr(app, "WEBHOOK_ASYNC", False)
+
+    def fail(event):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(app, "dispatch_event", fail)
+    assert post(client, [sticker_event("dispatch-failed")]).status_code == 500
+
+    monkeypatch.setattr(app, "dispatch_event", handled.append)
+    assert post(client, [sticker_event("dispatch-failed", redelivery=True)]).status_code == 200
+    assert [event.webhook_event_id for event in handled] == ["dispatch-failed"]
+
+
+def test_duplicate_is_dropped_after_success(client, monkeypatch):
+    client, handled = client
+    monkeypatch.setattr(app, "WEBHOOK_ASYNC", False)
+    assert post(client, [sticker_event("handled-once")]).status_code == 200
+    assert post(client, [sticker_event("handled-once", redelivery=True)]).status_code == 200
+    assert len(handled) == 1
+
+
+def test_stats_and_metrics_need_the_admin_token_once_it_is_set(monkeypatch):
+    client = app.app.test_client()
+    assert client.get("/metrics").status_code == 200
+    assert client.get("/admin/export/points").status_code == 401  # off without a token
+
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "s3cret")
+    for path in ("/metrics", "/webhook/stats", "/admin/export/points"):
+        assert client.get(path).status_code == 401
+        assert client.get(path, headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_failed_reply_does_not_make_the_event_run_again(monkeypatch):
+    monkeypatch.setattr(app, "WEBHOOK_ASYNC", False)
+    handled = []
+
+    def handle_sticker(event):
+        handled.append(event)
+        app.outbox.send(event.source.user_id, app.TextSendMessage(text="hi"))
+
+    def reply_message(token, messages):
+        raise LineBotApiError(500, {}, error=Error(message="Internal error"))
+    monkeypatch.setitem(app.handler._handlers, "MessageEvent_StickerMessage", handle_sticker)
+    monkeypatch.setattr(app.outbox.line_bot_api, "reply_message", reply_message)
+
+    client = app.app.test_client()
+    assert post(client, [sticker_event("reply-failed")]).status_code == 200
+    assert post(client, [sticker_event("reply-failed", redelivery=True)]).status_code == 200
+    assert len(handled) == 1
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+
+import storage
+from cache import LRUCache, MISSING
+from i18n import DEFAULT_LANGUAGE
+
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "10000"))
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "300"))  # seconds
+SETTINGS_VERSION_CHECK_INTERVAL = float(os.getenv("SETTINGS_VERSION_CHECK_INTERVAL", "1"))  # seconds
+
+SETTINGS_VERSION_KEY = "settings_version"
+
+DEFAULT_SETTINGS = {"language": DEFAULT_LANGUAGE, "location_consent": 0}
+
+
+class UserSettingsCache:
+    """ Read-through, write-through cache for the user_settings table.
+
+    Every write bumps the settings_version counter in the meta table. Each worker checks that
+    counter at most once per SETTINGS_VERSION_CHECK_INTERVAL and drops its cache when another
+    worker changed something, so all gunicorn workers agree within about a second.
+    """
+
+    def __init__(self, maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self.invalidations = 0
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._checked_at < SETTINGS_VERSION_CHECK_INTERVAL:
+            return
+        version = storage.read_counter(SETTINGS_VERSION_KEY)
+        with self._lock:
+            self._checked_at = now
+            if version != self._version:
+                if self._version is not None:
+                    self.cache.clear()
+                    self.invalidations += 1
+                self._version = version
+
+    def get(self, user_id):
+        """ Returns {"language": ..., "location_consent": ...} for a user. """
+        self._check_version()
+        settings = self.cache.get(user_id)
+        if settings is not MISSING:
+            return settings
+
+        row = storage.query_one("SELECT language, location_consent FROM user_settings WHERE user_id = ?", (user_id,))
+        settings = {"language": row[0], "location_consent": row[1]} if row else dict(DEFAULT_SETTINGS)
+        self.cache.set(user_id, settings)
+        return settings
+
+    def update(self, user_id, **changes):
+        """ Saves changed settings (language and/or location_consent) and updates the cache. """
+        with storage.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO user_settings (user_id) VALUES (?)", (user_id,))
+            for column, value in changes.items():
+                if column not in DEFAULT_SETTINGS:
+                    raise ValueError(f"Unknown user setting: {column}")
+                conn.execute(f"UPDATE user_settings SET {column} = ? WHERE user_id = ?", (value, user_id))
+            row = conn.execute("SELECT language, location_consent FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+            version = storage.bump_counter(conn, SETTINGS_VERSION_KEY)
+
+        with self._lock:
+            if self._version is not None and version != self._version + 1:
+                self.cache.clear()  # someone else changed settings too, start fresh
+                self.invalidations += 1
+            self._version = version
+        self.cache.set(user_id, {"language": row[0], "location_consent": row[1]})
+
+    def invalidate(self, user_id=None):
+        """ Drops one user (or everyone) from this worker's cache. """
+        if user_id is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(user_id)
+
+    def stats(self):
+        return {**self.cache.stats(), "invalidations": self.invalidations}
+
+
+settings_cache = UserSettingsCache()
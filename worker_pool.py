@@ -0,0 +1,136 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+QUEUE_WAIT = metrics.histogram("staircase_event_queue_wait_seconds", "Time events spent queued before a worker picked them up")
+EVENT_RUN = metrics.histogram("staircase_event_run_seconds", "Time workers spent handling an event")
+
+
+class KeyedWorkerPool:
+    """ Runs jobs on a fixed number of background threads.
+
+    Jobs submitted with the same key always land on the same worker, so they run
+    one after another in the order they were submitted (e.g. one user's scans).
+    """
+
+    def __init__(self, workers=4, max_queue=1000, put_timeout=1.0, name="event-worker"):
+        self.workers = max(1, workers)
+        self.put_timeout = put_timeout
+        self.name = name
+        per_worker = max(1, max_queue // self.workers)
+        self._queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+
+        # Stats (guarded by self._lock)
+        self._submitted = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._max_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    def _start(self):
+        """ Starts the worker threads lazily, so they are created inside each gunicorn worker process. """
+        with self._lock:
+            if self._threads:
+                return
+            for i, q in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(q,), name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _queue_for(self, key):
+        return self._queues[zlib.crc32(str(key).encode("utf-8")) % self.workers]
+
+    def submit(self, key, func, *args):
+        """ Queues func(*args) behind earlier jobs with the same key. Returns False if the queue stays full. """
+        if not self._threads:
+            self._start()
+
+        try:
+            self._queue_for(key).put((time.monotonic(), func, args), timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+        with self._lock:
+            self._submitted += 1
+            self._max_depth = max(self._max_depth, self.depth())
+        return True
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                q.task_done()
+                return
+
+            enqueued_at, func, args = item
+            started_at = time.monotonic()
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                failed = True
+                logger.exception("🚨 Background job failed")
+            finished_at = time.monotonic()
+            q.task_done()
+
+            wait, run = started_at - enqueued_at, finished_at - started_at
+            QUEUE_WAIT.observe(wait)
+            EVENT_RUN.observe(run)
+            with self._lock:
+                self._processed += 1
+                self._failed += failed
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                self._run_total += run
+                self._run_max = max(self._run_max, run)
+
+    def depth(self):
+        """ Number of jobs waiting across all worker queues. """
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        """ Returns a snapshot of queue depth and latency counters. """
+        with self._lock:
+            processed = self._processed or 1
+            return {
+                "workers": self.workers,
+                "depth": self.depth(),
+                "max_depth": self._max_depth,
+                "submitted": self._submitted,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "avg_wait_ms": round(self._wait_total / processed * 1000, 2),
+                "max_wait_ms": round(self._wait_max * 1000, 2),
+                "avg_run_ms": round(self._run_total / processed * 1000, 2),
+                "max_run_ms": round(self._run_max * 1000, 2),
+            }
+
+    def shutdown(self, timeout=10.0):
+        """ Lets the workers drain what is already queued, then stops them. """
+        if not self._threads:
+            return
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            try:
+                q.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                logger.warning("🚨 Worker queue still full at shutdown, some events were not processed")
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))